@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Benchmark the time it takes to import ultratils modules.
+
+# Each module is imported in a fresh interpreter, repeat times, and the
+# fastest and median wall times are reported after subtracting the startup
+# time of an interpreter that imports nothing. With --verbose the modules
+# loaded by each import are listed in the order of their cumulative import
+# time, as reported by `python -X importtime` (Python 3.7+).
+
+import os, sys
+import getopt
+import subprocess
+import time
+
+DEFAULT_MODULES = [
+    'ultratils.pysonix.bprreader',
+    'ultratils.pysonix.probe',
+    'ultratils.pysonix.scanconvert',
+    'ultratils.acq',
+    'ultratils.exp',
+    'ultratils.utils',
+    'ultratils.psync',
+]
+
+def usage():
+    print("""bench_import_time.py [--repeat|-n N] [--verbose] [module1 ...]
+
+Report the import time of each module (default: the main ultratils modules).
+""")
+
+def run_time(code, repeat):
+    """Return a sorted list of wall times of running code in a new interpreter."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        times.append(time.time() - start)
+    return sorted(times)
+
+def slowest_imports(module, count=10):
+    """Return the count slowest imports of module as (seconds, name) tuples."""
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE
+    )
+    (out, err) = proc.communicate()
+    imports = []
+    for line in err.decode('utf-8').splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]) / 1e6, fields[2].rstrip()))
+    imports.sort(reverse=True)
+    return imports[:count]
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:h", ["repeat=", "help", "verbose"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    repeat = 5
+    verbose = False
+    for o, a in opts:
+        if o in ('-n', '--repeat'):
+            repeat = int(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--verbose':
+            verbose = True
+    modules = args if len(args) > 0 else DEFAULT_MODULES
+
+    base = run_time('pass', repeat)
+    print("{:40s} {:>10s} {:>10s}".format('module', 'min (s)', 'median (s)'))
+    print("{:40s} {:10.4f} {:10.4f}".format('(interpreter startup)', base[0], base[len(base) // 2]))
+    for module in modules:
+        try:
+            times = run_time('import ' + module, repeat)
+        except subprocess.CalledProcessError:
+            sys.stderr.write("Could not import {:s}.\n".format(module))
+            continue
+        print("{:40s} {:10.4f} {:10.4f}".format(
+            module, times[0] - base[0], times[len(times) // 2] - base[len(base) // 2]
+        ))
+        if verbose:
+            for (secs, name) in slowest_imports(module):
+                print("    {:10.4f} {:s}".format(secs, name))
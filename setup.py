@@ -6,12 +6,25 @@ from Cython.Distutils import build_ext
 import numpy
 import sys
 
+import os
+
+# The scanconvert kernels use OpenMP to convert frames on multiple cores. Set
+# ULTRATILS_NO_OPENMP to build without it, e.g. with compilers that do not
+# support OpenMP; the kernels then run on a single core.
+if os.environ.get('ULTRATILS_NO_OPENMP'):
+  openmp_args = []
+elif sys.platform == 'win32':
+  openmp_args = ['/openmp']
+else:
+  openmp_args = ['-fopenmp']
+
 if sys.platform == 'win32':
   ext_modules = [
     Extension(
       name="ultratils.pysonix.scanconvert",
       sources=["ultratils/pysonix/scanconvert.pyx"],
       include_dirs=[numpy.get_include(), "."],
+      extra_compile_args=openmp_args,
       language="c",
     )
   ]
@@ -22,6 +35,8 @@ else:
       sources=["ultratils/pysonix/scanconvert.pyx"],
       libraries = ["m"],
       include_dirs=[numpy.get_include(), "."],
+      extra_compile_args=openmp_args,
+      extra_link_args=openmp_args,
       language="c",
     )
   ]
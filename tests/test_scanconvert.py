@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Regression tests for Converter.convert() and Converter.convert_many().
+# The expected output is computed with the pixel mapping of the original
+# per-pixel Converter implementation.
+
+import io
+import struct
+import numpy as np
+import pytest
+
+from ultratils.pysonix.bprreader import Header
+from ultratils.pysonix.probe import Probe
+from ultratils.pysonix.scanconvert import Converter
+
+H = 128
+W = 64
+PROBE_ID = 19
+
+def make_header(h=H, w=W, probe=PROBE_ID):
+    '''Return a bpr Header for frames of shape (h, w).'''
+    fields = [2, 1, w, h, 8, 0, 0, 0, 0, 0, 0, 0, 0, probe, 0, 8000000, 0, 0, 0]
+    return Header(io.BytesIO(struct.pack('I' * 19, *fields)))
+
+def baseline_indexes(header, probe, ppmm=2):
+    '''Return the (bmp_index, bpr_index, shape) mapping of the original
+    nearest-neighbour Converter.'''
+    apitch = 1540/2/float(header.sf)
+    lpitch = float(probe.pitch)*1e-6*probe.numElements/header.w
+    radius = probe.radius*1e-6
+    t = (np.arange(0, header.w)-header.w/2)*lpitch/radius
+    r = radius + np.arange(0, header.h)*apitch
+    (t, r) = np.meshgrid(t, r)
+    x = r*np.cos(t)
+    y = r*np.sin(t)
+    xreg = np.arange(np.min(x), np.max(x), step=1e-3/ppmm)
+    yreg = np.arange(np.min(y), np.max(y), step=1e-3/ppmm)
+    [yreg, xreg] = np.meshgrid(yreg, xreg)
+    bmp_index = []
+    bpr_index = []
+    for xCntr in np.arange(0, xreg.shape[1]):
+        for yCntr in np.arange(0, yreg.shape[0]):
+            xv = xreg[yCntr, xCntr]
+            yv = yreg[yCntr, xCntr]
+            theta = np.arctan2(yv, xv)
+            rho = np.hypot(xv, yv)
+            indt = int(np.floor(theta/(lpitch/radius)+header.w/2) + 1)
+            indr = int(np.floor((rho-radius)/apitch) + 1)
+            if indt > 0 and indt < header.w and indr > 0 and indr < header.h:
+                bmp_index.append(np.ravel_multi_index((yCntr, xCntr), xreg.shape))
+                bpr_index.append(np.ravel_multi_index((indr, indt), (header.h, header.w)))
+    return (np.array(bmp_index), np.array(bpr_index), xreg.shape)
+
+@pytest.fixture(scope='module')
+def setup():
+    header = make_header()
+    probe = Probe(PROBE_ID)
+    conv = Converter(header, probe, cache=False)
+    return (conv, baseline_indexes(header, probe))
+
+def expected(frame, indexes):
+    (bmp_index, bpr_index, shape) = indexes
+    out = np.zeros(shape, dtype=frame.dtype)
+    out.ravel()[bmp_index] = frame.ravel()[bpr_index]
+    return out
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_convert_matches_baseline(setup, dtype):
+    (conv, indexes) = setup
+    rng = np.random.RandomState(0)
+    hi = 255 if dtype == np.uint8 else 51000
+    frame = rng.randint(0, hi + 1, size=(H, W)).astype(dtype)
+    out = conv.convert(frame)
+    assert out.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(out, expected(frame, indexes))
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+@pytest.mark.parametrize('nframes', [3, 12])
+def test_convert_many_matches_convert(setup, dtype, nframes):
+    (conv, indexes) = setup
+    rng = np.random.RandomState(1)
+    hi = 255 if dtype == np.uint8 else 51000
+    frames = rng.randint(0, hi + 1, size=(nframes, H, W)).astype(dtype)
+    many = conv.convert_many(frames)
+    assert many.dtype == np.dtype(dtype)
+    for frame, out in zip(frames, many):
+        np.testing.assert_array_equal(out, expected(frame, indexes))
+        np.testing.assert_array_equal(out, conv.convert(frame))
+    np.testing.assert_array_equal(conv.convert(frames), many)
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_bilinear_kernel_matches_numpy_path(dtype):
+    conv = Converter(make_header(), Probe(PROBE_ID), interpolation='bilinear', cache=False)
+    rng = np.random.RandomState(2)
+    frames = (rng.rand(12, H, W) * 250).astype(dtype)
+    many = conv.convert_many(frames)   # batches of 8 or more use the kernel
+    for frame, out in zip(frames, many):
+        np.testing.assert_array_equal(out, conv.convert(frame))
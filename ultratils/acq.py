@@ -4,24 +4,21 @@
 
 import os, sys
 import re
+import subprocess
 from datetime import datetime
 from dateutil.tz import tzlocal
 from collections import OrderedDict
 from collections import namedtuple
 import numpy as np
-import pandas as pd
-import audiolabel
 from ultratils.pysonix.bprreader import BprReader
+from ultratils.archive import ArchiveReader, ARCHIVE_EXT
+from ultratils.syncindex import SyncIndex
 import ultratils.pysonix.probe
 import ultratils.pysonix.scanconvert
 
-# These are needed for make_mp4()
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import matplotlib.animation as manimation
-import scipy.io.wavfile
-import subprocess
+# pandas, audiolabel, and the matplotlib and scipy modules needed by
+# make_mp4() are slow to import, so they are imported by the methods that
+# use them instead of at the top of this module.
 
 # Regex that matches a timezone offset at the end of an acquisition directory
 # name.
@@ -76,6 +73,18 @@ def read_params(pfile):
                 pass
     return params
 
+def read_runtime_var_names(rvfile):
+    """Read the names of the runtime variables from a runtime_vars.txt file,
+which has one name per line."""
+    with open(rvfile, 'r') as f:
+        return [line.split()[0] for line in f if line.strip() != '']
+
+# Attributes that are set by Acq.gather().
+GATHER_ATTRS = (
+    'n_frames', 'image_h', 'image_w', 'probe_id', 'imaging_params', 'versions',
+    'stimulus', 'n_pulse_idx', 'n_raw_data_idx', 'pulse_max', 'pulse_min'
+)
+
 class AcqError(Exception):
     """Base class for errors in this module."""
     def __init__(self, msg):
@@ -113,11 +122,14 @@ class Acq():
     def runtime_vars(self):
         if self._runtime_vars is None:
             try:
-                df = pd.read_csv(self.abs_runtime_vars, sep='\s+', header=None)
+                if self._index is None:
+                    myvars = read_runtime_var_names(self.abs_runtime_vars)
+                else:
+                    myvars = self._index.runtime_var_names()
                 (mypath, ts) = os.path.split(self.relpath)
                 is_timestamp(ts)
                 t = []
-                myvars = df.iloc[:,0].tolist()
+                myvars = list(myvars)
                 myvars.reverse()
                 for var in myvars:
                     (mypath, val) = os.path.split(mypath)
@@ -132,6 +144,8 @@ class Acq():
 
     @property
     def abspath(self):
+        if self._abspath is None and self._index is not None:
+            self._abspath = self._index.path(self.timestamp)
         if self._abspath is None:
             for mydir, subdirs, files in os.walk(os.path.abspath(self.expdir)):
                 if os.path.basename(mydir) == self.timestamp:
@@ -143,10 +157,18 @@ class Acq():
     def abs_sync_tg(self):
         return os.path.join(self.abspath, "{:}.{:}.sync.TextGrid".format(self.timestamp, self.dtype))
 
+    @property
+    def abs_sync_npz(self):
+        return os.path.join(self.abspath, "{:}.{:}.sync.npz".format(self.timestamp, self.dtype))
+
     @property
     def abs_image_file(self):
         return os.path.join(self.abspath, "{:}.{:}".format(self.timestamp, self.dtype))
 
+    @property
+    def abs_archive_file(self):
+        return '{:}{:}'.format(self.abs_image_file, ARCHIVE_EXT)
+
     @property
     def abs_audio_file(self):
         return '{:}.wav'.format(self.abs_image_file)
@@ -176,9 +198,10 @@ class Acq():
         """Return the frames/second."""
         rate = self._framerate
         if rate is None:
-            frames = self.sync_lm.tier('pulse_idx').search(r'\w')
-            t1 = frames[0].t1
-            t2 = frames[-1].t2
+            sidx = self.sync_index
+            frames = np.nonzero(sidx.pulse_idx >= 0)[0]
+            t1 = sidx.t1[frames[0]]
+            t2 = sidx.t2[frames[-1]]
             rate = len(frames) / (t2 - t1)
             self._framerate = rate
         return rate
@@ -188,6 +211,7 @@ class Acq():
         """The LabelManager for .sync.textgrid."""
         lm = self._sync_lm
         if lm is None:
+            import audiolabel
             lm = audiolabel.LabelManager(
                 from_file=self.abs_sync_tg,
                 from_type='praat'
@@ -195,23 +219,55 @@ class Acq():
             self._sync_lm = lm
         return lm
 
+    @property
+    def sync_index(self):
+        """The SyncIndex of the acquisition's synchronization intervals. It is
+loaded from the .sync.npz sidecar file if there is one, and otherwise from
+the .sync.TextGrid. The .sync.TextGrid is used instead if it is newer than
+the .sync.npz, e.g. after it has been edited by hand."""
+        idx = self._sync_index
+        if idx is None:
+            try:
+                npz_mtime = os.path.getmtime(self.abs_sync_npz)
+            except OSError:
+                npz_mtime = None
+            try:
+                tg_mtime = os.path.getmtime(self.abs_sync_tg)
+            except OSError:
+                tg_mtime = None
+            if npz_mtime is not None and (tg_mtime is None or tg_mtime <= npz_mtime):
+                idx = SyncIndex.load(self.abs_sync_npz)
+            else:
+                idx = SyncIndex.from_label_manager(self.sync_lm)
+            self._sync_index = idx
+        return idx
+
     @property
     def raw_data_idx(self):
-        """The LabelManager 'raw_data_idx' tier."""
+        """The LabelManager 'raw_data_idx' tier, parsed from the
+.sync.TextGrid. Use sync_index to look up frames, which also works with
+only the .sync.npz sidecar."""
         return self.sync_lm.tier('raw_data_idx')
 
     @property
     def pulse_idx(self):
-        """The LabelManager 'pulse_idx' tier."""
+        """The LabelManager 'pulse_idx' tier, parsed from the .sync.TextGrid.
+Use sync_index for the pulse_idx values, which also works with only the
+.sync.npz sidecar."""
         return self.sync_lm.tier('pulse_idx')
 
     @property
     def image_reader(self):
-        """The image reader."""
+        """The image reader. If the image file is missing but an archived
+copy exists, an ArchiveReader for the archive is used."""
         rdr = self._image_reader
         if rdr is None:
             if self.dtype == 'bpr':
-                rdr = BprReader(self.abs_image_file)
+                if not os.path.exists(self.abs_image_file) and \
+                   os.path.exists(self.abs_archive_file):
+                    rdr = ArchiveReader(self.abs_archive_file)
+                else:
+                    rdr = BprReader(self.abs_image_file)
             self._image_reader = rdr
         return rdr
 
@@ -220,33 +276,53 @@ class Acq():
         """A Probe object."""
         probe = self._probe
         if probe is None:
-            if self.dtype == 'bpr':
+            if self.probe_id is not None:
+                probe = ultratils.pysonix.probe.Probe(self.probe_id)
+            elif self.dtype == 'bpr':
                 probe = ultratils.pysonix.probe.Probe(
                     self.image_reader.header.probe
                 )
-                self._probe = probe
+            self._probe = probe
         return probe
 
     @property
     def image_converter(self):
-        """Converter object for converting raw image data to interpolated format."""
+        """Converter object for converting raw image data to interpolated format.
+The Converter is shared with all other acquisitions that have the same
+probe and image geometry."""
         c = self._image_converter
         if c is None:
             if self.dtype == 'bpr':
-                c = ultratils.pysonix.scanconvert.Converter(
+                c = ultratils.pysonix.scanconvert.get_converter(
                     self.image_reader.header,
                     self.probe
                 )
                 self._image_converter = c
         return c
 
-    def __init__(self, timestamp=None, expdir=None, dtype='bpr', abspath=abspath, image_converter=None):
+    def __init__(self, timestamp=None, expdir=None, dtype='bpr', abspath=None, image_converter=None, index=None, runtime_vars=None):
+        """timestamp = the acquisition timestamp, which is also the name of its directory
+expdir = the root experiment directory
+dtype = image data type
+abspath = the acquisition directory; if None it is looked up in index or
+  found by searching expdir
+image_converter = optional Converter to use instead of the shared Converter
+  for the acquisition's geometry
+index = optional ultratils.exp.ExpIndex of expdir, used to find the
+  acquisition directory and runtime variables without searching expdir
+runtime_vars = optional list of (name, val) runtime variable pairs, e.g.
+  from a catalog, to use instead of reading runtime_vars.txt
+"""
         self.utcoffset = is_timestamp(timestamp)
         self.timestamp = timestamp
         self.expdir = os.path.normpath(expdir)
         self.dtype = dtype
+        self._index = index
         self._abspath = abspath
-        self._runtime_vars = None
+        if runtime_vars is None:
+            self._runtime_vars = None
+        else:
+            self._runtime_vars = [RuntimeVar(n, v) for (n, v) in runtime_vars]
         self.relpath = self.abspath.replace(self.expdir, '')
         self.runvars = RuntimeVars()
         if self.runtime_vars is not None:
@@ -255,6 +331,7 @@ class Acq():
         self._image_reader = None
         self._framerate = None
         self._sync_lm = None
+        self._sync_index = None
         if image_converter is None:
             self._image_converter = None
         else:
@@ -265,6 +342,7 @@ class Acq():
                 sys.stderr.write('INFO: ignoring non-matching image_converter for acquisition {:}.'.format(timestamp))
                 self._image_converter = None
         self._probe = None
+        self.probe_id = None
 
     def gather(self, params_file='params.cfg'):
         """Gather the metadata from an acquisition directory."""
@@ -276,11 +354,12 @@ class Acq():
                 self.n_frames = None
                 self.image_h = None
                 self.image_w = None
-                self._probe = None
-            self.n_frames = rdr.header.nframes
-            self.image_h = rdr.header.h
-            self.image_w = rdr.header.w
-            self._probe = rdr.header.probe
+                self.probe_id = None
+            else:
+                self.n_frames = rdr.header.nframes
+                self.image_h = rdr.header.h
+                self.image_w = rdr.header.w
+                self.probe_id = rdr.header.probe
         else:
             raise AcqError("Unknown type '{:}' specified.".format(type))
         try:
@@ -298,11 +377,11 @@ class Acq():
         except IOError:
             self.stimulus = None
         try:
-            tg = self.abs_sync_tg
-            lm = audiolabel.LabelManager(from_file=tg, from_type='praat')
-            durs = [l.duration for l in lm.tier('pulse_idx').search(r'^\d+$')]
+            sidx = self.sync_index
+            pulses = sidx.pulse_idx >= 0
+            durs = (sidx.t2 - sidx.t1)[pulses]
             self.n_pulse_idx = len(durs)
-            self.n_raw_data_idx = len([l for l in lm.tier('raw_data_idx').search(r'^\d+$')])
+            self.n_raw_data_idx = int(np.count_nonzero(~sidx.missing))
             self.pulse_max = np.max(durs)
             self.pulse_min = np.min(durs)
         except IOError as e:
@@ -315,66 +394,106 @@ class Acq():
         """Return an ordered dict with the Acq attributes as key/value pairs."""
         d = OrderedDict()
         for fld in fields:
-            d[fld] = getattr(self, fld)
+            try:
+                d[fld] = getattr(self, fld)
+            except AttributeError:   # a runtime variable
+                d[fld] = getattr(self.runvars, fld)
         return d
 
     def frame_at(self, t, convert=False, missing_val=None):
         """Return image frame data at time t. If convert is True, use the acquisition's image_converter to do a scanconvert. If missing_val is True, return a replacement frame if the frame at time t is missing.
 
 By default frame_at() returns a 2D numpy array of image data or None if no image data is available at time t.
-If missing_val is not None, frame_at() returns a tuple """
+If missing_val is not None, frame_at() returns a tuple
+
+The label returned with the frame is a SyncLabel of the sync_index interval
+whose frame was used, with t1, t2 and text attributes, or None."""
         frame = None
         repfr = None
-        l = self.raw_data_idx.label_at(t)
-        while True:
-            try:
-                fidx = int(l.text) # ValueError if 'NA' or ''
-                break              # Got a valid time
-            except ValueError:
-                if missing_val == 'prev':
-                    if self.raw_data_idx[0] == l:
-                        l = None
-                        break
-                    else:
-                        l = self.raw_data_idx.prev(l)
-                elif missing_val == 'next':
-                    if self.raw_data_idx[-1] == l:
-                        l = None
-                        break
-                    else:
-                        l = self.raw_data_idx.next(l)
-                elif missing_val is not None:
-                    repfr = self.image_reader.get_frame(0)
-                    repfr = (repfr * 0) + missing_val
-                    l = None
-                    break
-                else:
-                    l = None
-                    break
-        if l is not None:
-            if l == self.raw_data_idx.label_at(t):
+        l = None
+        sidx = self.sync_index
+        iidx = int(sidx.interval_at(t))
+        if missing_val in ('prev', 'next'):
+            fint = int(sidx.frame_intervals(t, missing_val))
+        else:
+            fint = int(sidx.frame_intervals(t))
+        if fint >= 0:
+            l = sidx.label(fint)
+            fidx = int(sidx.raw_data_idx[fint])
+            if fint == iidx:
                 frame = self.image_reader.get_frame(fidx)
             else:
                 repfr = self.image_reader.get_frame(fidx)
+        elif missing_val not in (None, 'prev', 'next'):
+            repfr = self.image_reader.get_frame(0)
+            repfr = (repfr * 0) + missing_val
         if frame is not None and convert is True:
-            frame = self.image_converter.as_bmp(frame)
+            frame = self.image_converter.convert(frame)
         if repfr is not None and convert is True:
-            repfr = self.image_converter.as_bmp(repfr)
+            repfr = self.image_converter.convert(repfr)
         if missing_val is None:
             return (frame, l)
         else:
             return (frame, l, repfr)
 
+    def frames_at(self, times, missing=0, convert=False):
+        """Return the image frames at times as an (n, h, w) array, together with
+a 1D int array of the raw_data_idx of each frame that is -1 where no frame
+is available.
+
+missing = 'prev' or 'next' to use the nearest frame before or after a time
+  that has no frame of its own; or a value to fill frames that are missing
+  with, which must be representable in the dtype of the image data, e.g.
+  0-255 for bpr data. Frames that are missing and have no earlier ('prev')
+  or later ('next') frame are filled with 0.
+convert = if True, scan-convert the frames with the acquisition's
+  image_converter; missing frames are filled entirely with the fill value,
+  including the area outside the fan
+
+Each frame is read from the image file once, however many times refer to it.
+"""
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        if missing in ('prev', 'next'):
+            fidx = self.sync_index.frame_indexes(times, missing)
+            fill = 0
+        else:
+            fidx = self.sync_index.frame_indexes(times)
+            fill = missing
+        dtype = np.dtype(self.image_reader.dtype)
+        with np.errstate(invalid='ignore'):
+            fits = np.array(fill).astype(dtype) == fill
+        if not fits:
+            msg = "Fill value {:} cannot be represented as {:}.".format(fill, dtype)
+            raise ValueError(msg)
+        found = fidx >= 0
+        (uniq, inverse) = np.unique(fidx[found], return_inverse=True)
+        frames = self.image_reader.get_frames(uniq)
+        if convert is True:
+            frames = self.image_converter.convert_many(frames)
+        fillframe = np.full(frames.shape[1:], fill, dtype=frames.dtype)
+        out = np.empty((len(times),) + frames.shape[1:], dtype=frames.dtype)
+        out[found] = frames[inverse]
+        out[~found] = fillframe
+        return (out, fidx)
+
     def make_mp4(self, t1=None, t2=None, outfile=None, metadata={}, fill=True, audio=True, corrected=True):
         """Make an .mp4, starting at t1 and ending at t2. The metadata parameter is a dict suitable for use with the Matplotlib animation ffmpeg writer. If fille is True, insert blank for missing frames. If corrected is False use raw scanline data in rectangular format. If corrected is True interpolate the scanline data to correct for transducer geometry."""
-        labels = self.sync_lm.tier('raw_data_idx').tslice(t1=t1, t2=t2)
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import matplotlib.animation as manimation
+        sidx = self.sync_index
+        rdidxs = [
+            int(i) if i >= 0 else None
+            for i in sidx.raw_data_idx[sidx.intervals_between(t1, t2)]
+        ]
         blank_intensity = 0
         if self.dtype == 'bpr':
             if corrected is True:
                 blankbpr = self.image_converter.default_bpr_frame(blank_intensity)
-                blank = self.image_converter.as_bmp(blankbpr).astype(np.uint8)
+                blank = self.image_converter.convert(blankbpr)
             else:
-                blank = self.image_reader.get_frame(0).astype(np.uint8) * 0
+                blank = np.zeros_like(self.image_reader.get_frame(0))
         else:
             raise AcqError(
                 "make_mp4() not implemented for acquisition with dtype {}.".format(
@@ -399,22 +518,24 @@ If missing_val is not None, frame_at() returns a tuple """
             fps=self.framerate,
             metadata=metadata
         )
-        with writer.saving(fig, 'tmp_vid.mp4', 100):
-            for l in labels:
-                try:
-                    rdidx = int(l.text)
-                    d = self.image_reader.get_frame(rdidx)
+        # Read frames in the background while the current one is encoded.
+        frames = self.image_reader.prefetch([i for i in rdidxs if i is not None])
+        with writer.saving(fig, 'tmp_vid.mp4', 100), frames:
+            for rdidx in rdidxs:
+                if rdidx is not None:
+                    d = next(frames)
                     if corrected is True:
-                        frame = np.flipud(self.image_converter.as_bmp(d).astype(np.uint8))
+                        frame = np.flipud(self.image_converter.convert(d))
                     else:
                         frame = np.flipud(d)
-                except ValueError:   # l.text is 'NA'
+                else:
                     frame = blank
                 p.set_data(frame)
                 plt.show()
                 writer.grab_frame()
 
         if audio is True:
+            import scipy.io.wavfile
             arate, d = scipy.io.wavfile.read(self.abs_audio_file)
             aidx0 = int(np.round(t1 * arate))
             aidx1 = int(np.round(t2 * arate))
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+# Chunked, compressed archives of ultrasound image frames.
+
+# An archive stores a sequence of image frames in compressed chunks of
+# chunk_frames frames each, using one of the compression codecs of the
+# standard library. An index of chunk locations at the end of the file
+# allows any frame to be read by decompressing only the chunk that contains
+# it. Frames are stored in the orientation returned by the readers'
+# get_frame() methods, i.e. as (h, w) arrays.
+#
+# File layout (all integers little-endian):
+#
+#   file header:  magic (4s), codec (8s), dtype (8s), h (I), w (I),
+#                 chunk_frames (I), has_bpr_header (I), bpr header (76s)
+#   chunks:       compressed chunk data, one after another
+#   chunk index:  nchunks pairs of (offset (Q), length (Q))
+#   trailer:      nframes (Q), nchunks (Q), index offset (Q), magic (4s)
+#
+# If the frames came from a .bpr file, its header is kept in the archive so
+# that an ArchiveReader can be used in place of a BprReader.
+
+import os
+import io
+import struct
+import threading
+import zlib
+import bz2
+import numpy as np
+from ultratils.frameio import as_indices, frames_out, pread, Prefetcher
+from ultratils.pysonix.bprreader import BprReader, Header
+
+ARCHIVE_EXT = '.ufa'
+MAGIC = b'UFA1'
+FILE_HDR = struct.Struct('<4s8s8sIIII76s')
+TRAILER = struct.Struct('<QQQ4s')
+BPR_HDR_SIZE = 76
+
+def _compressor(codec, level):
+    '''Return a function that compresses bytes with codec.'''
+    if codec == 'zlib':
+        return lambda b: zlib.compress(b, 6 if level is None else level)
+    elif codec == 'bz2':
+        return lambda b: bz2.compress(b, 9 if level is None else level)
+    elif codec == 'lzma':
+        import lzma
+        return lambda b: lzma.compress(b, preset=level)
+    elif codec == 'none':
+        return lambda b: b
+    raise ArchiveError("Unknown codec '{:}'.".format(codec))
+
+def _decompressor(codec):
+    '''Return a function that decompresses bytes compressed with codec.'''
+    if codec == 'zlib':
+        return zlib.decompress
+    elif codec == 'bz2':
+        return bz2.decompress
+    elif codec == 'lzma':
+        import lzma
+        return lzma.decompress
+    elif codec == 'none':
+        return lambda b: b
+    raise ArchiveError("Unknown codec '{:}'.".format(codec))
+
+class ArchiveError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class ArchiveWriter(object):
+    '''Class for writing image frames to an archive file.
+
+    Parameters
+    ----------
+    filename : str
+    The name of the archive file to create.
+
+    h, w : int
+    The height and width of each frame.
+
+    Optional parameters
+    -------------------
+
+    dtype : data type (default np.uint8)
+    The data type of the frames.
+
+    chunk_frames : int (default 32)
+    The number of frames compressed together in each chunk. Larger chunks
+    compress better; smaller chunks make random access cheaper.
+
+    codec : str (default 'zlib')
+    The compression codec; one of 'zlib', 'bz2', 'lzma' or 'none'.
+
+    level : int (default None)
+    The compression level, or None for the codec's default.
+
+    bpr_header : bytes (default None)
+    The raw header of the .bpr file the frames came from, if any.
+    '''
+    def __init__(self, filename, h, w, dtype=np.uint8, chunk_frames=32,
+codec='zlib', level=None, bpr_header=None):
+        self.filename = os.path.abspath(filename)
+        self.h = h
+        self.w = w
+        self.dtype = np.dtype(dtype)
+        self.chunk_frames = chunk_frames
+        self.codec = codec
+        self._compress = _compressor(codec, level)
+        self._chunk = np.empty([chunk_frames, h, w], dtype=self.dtype)
+        self._nchunk = 0     # number of frames in the current chunk
+        self._index = []
+        self.nframes = 0
+        self._fhandle = open(self.filename, 'wb')
+        self._fhandle.write(FILE_HDR.pack(
+            MAGIC, codec.encode('ascii'), self.dtype.str.encode('ascii'),
+            h, w, chunk_frames, bpr_header is not None,
+            b'' if bpr_header is None else bpr_header
+        ))
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, frames):
+        '''Append a frame, or an (n, h, w) array of frames, to the archive.'''
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        pos = 0
+        while pos < len(frames):
+            n = min(self.chunk_frames - self._nchunk, len(frames) - pos)
+            self._chunk[self._nchunk:self._nchunk + n] = frames[pos:pos + n]
+            self._nchunk += n
+            pos += n
+            if self._nchunk == self.chunk_frames:
+                self._flush()
+        self.nframes += len(frames)
+
+    def _flush(self):
+        '''Compress and write the current chunk.'''
+        if self._nchunk == 0:
+            return
+        data = self._compress(self._chunk[:self._nchunk].tobytes())
+        self._index.append((self._fhandle.tell(), len(data)))
+        self._fhandle.write(data)
+        self._nchunk = 0
+
+    def close(self):
+        '''Write the remaining frames and the chunk index, and close the file.'''
+        if self._fhandle is None:
+            return
+        self._flush()
+        index_offset = self._fhandle.tell()
+        self._fhandle.write(np.array(self._index, dtype='<u8').tobytes())
+        self._fhandle.write(TRAILER.pack(
+            self.nframes, len(self._index), index_offset, MAGIC
+        ))
+        self._fhandle.close()
+        self._fhandle = None
+
+class ArchiveReader(object):
+    '''Class for reading image frames from an archive file. The interface
+    is the same as BprReader's: frames are available by index with
+    `get_frame()` and `get_frames()`, or by iterating over the reader.
+
+    If the archive was made from a .bpr file, the `header` attribute holds
+    its bpr Header, with `nframes` set to the number of archived frames;
+    otherwise `header` is None.
+
+    Decompressed chunks are cached, so reading neighboring frames in order
+    decompresses each chunk once. Reads are positional and the reader may
+    be shared between threads as described for BprReader.
+
+    Archives are complete when written, so `refresh()` only returns nframes,
+    and `data` decompresses the whole archive into memory rather than
+    mapping it.
+
+    Parameters
+    ----------
+    filename : str
+    The name of the archive file to read.
+
+    Optional parameters
+    -------------------
+
+    cache_chunks : int (default 2)
+    The number of decompressed chunks to keep in memory.
+    '''
+    def __init__(self, filename, cache_chunks=2):
+        self.filename = os.path.abspath(filename)
+        self._fhandle = None
+        self._lock = threading.RLock()
+        self._cache = []     # (chunk index, frames) pairs, most recent last
+        self.cache_chunks = cache_chunks
+        fhandle = self._handle()
+        (magic, codec, dtype, h, w, chunk_frames, has_bpr_header, bpr_header) = \
+            FILE_HDR.unpack(pread(fhandle, FILE_HDR.size, 0, self._lock))
+        size = os.fstat(fhandle.fileno()).st_size
+        trailer = pread(fhandle, TRAILER.size, size - TRAILER.size, self._lock)
+        (nframes, nchunks, index_offset, tmagic) = TRAILER.unpack(trailer)
+        if magic != MAGIC or tmagic != MAGIC:
+            msg = "{:} is not a complete frame archive.".format(self.filename)
+            raise ArchiveError(msg)
+        self.codec = codec.rstrip(b'\0').decode('ascii')
+        self._decompress = _decompressor(self.codec)
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        self.h = h
+        self.w = w
+        self.nframes = nframes
+        self.chunk_frames = chunk_frames
+        index = pread(fhandle, nchunks * 16, index_offset, self._lock)
+        self._index = np.frombuffer(index, dtype='<u8').reshape([nchunks, 2])
+        if has_bpr_header:
+            self.header = Header(io.BytesIO(bpr_header))
+            self.header.nframes = nframes
+        else:
+            self.header = None
+        self._cursor = 0
+        self._data = None
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def data(self):
+        '''Return all image frames as a read-only (nframes, w, h) ndarray in
+        the orientation of BprReader.data. The whole archive is decompressed
+        on first access and kept in memory.'''
+        if self._data is None:
+            data = self.get_frames(slice(None)).transpose(0, 2, 1)
+            data.flags.writeable = False
+            self._data = data
+        return self._data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        '''Get the next image frame.'''
+        with self._lock:
+            idx = self._cursor
+            if idx >= self.nframes:
+                raise StopIteration
+            self._cursor += 1
+        return self.get_frame(idx)
+
+    __next__ = next
+
+    def _get_chunk(self, cidx):
+        '''Return the decompressed frames of chunk cidx.'''
+        with self._lock:
+            for (c, frames) in self._cache:
+                if c == cidx:
+                    return frames
+        (offset, length) = self._index[cidx]
+        data = self._decompress(
+            pread(self._handle(), int(length), int(offset), self._lock)
+        )
+        frames = np.frombuffer(data, dtype=self.dtype).reshape([-1, self.h, self.w])
+        with self._lock:
+            self._cache.append((cidx, frames))
+            del self._cache[:max(len(self._cache) - self.cache_chunks, 0)]
+        return frames
+
+    def get_frame(self, idx=None):
+        '''Get the image frame specified by idx as a read-only array.'''
+        if idx < 0:
+            idx += self.nframes
+        if idx < 0 or idx >= self.nframes:
+            raise IndexError('{:}'.format(idx))
+        (cidx, fidx) = divmod(idx, self.chunk_frames)
+        return self._get_chunk(cidx)[fidx]
+
+    def get_frames(self, idx, out=None):
+        '''Get the image frames specified by idx and return them as a
+        contiguous (n, h, w) ndarray. idx may be a slice, a range, or a
+        sequence or ndarray of frame indexes in any order. If out is provided
+        it must be an (n, h, w) array and is filled and returned.'''
+        indices = as_indices(idx, self.nframes)
+        out = frames_out(out, [len(indices), self.h, self.w], self.dtype)
+        chunks = indices // self.chunk_frames
+        for cidx in np.unique(chunks):
+            sel = np.nonzero(chunks == cidx)[0]
+            out[sel] = self._get_chunk(cidx)[indices[sel] % self.chunk_frames]
+        return out
+
+    def prefetch(self, idx=None, depth=8):
+        '''Return an iterator over the frames in idx (all frames if None)
+        that reads up to depth frames ahead in a background thread, as
+        BprReader.prefetch() does.'''
+        if idx is None:
+            idx = slice(None)
+        indices = as_indices(idx, self.nframes)
+        return Prefetcher(self, indices, [self.h, self.w], self.dtype, depth)
+
+    def refresh(self):
+        '''Return nframes. An archive does not grow once it is written.'''
+        return self.nframes
+
+    def _handle(self):
+        '''Return the open file handle, opening it if necessary.'''
+        with self._lock:
+            if self._fhandle is None:
+                self.open()
+            return self._fhandle
+
+    def open(self):
+        self._fhandle = open(self.filename, 'rb')
+
+    def close(self):
+        try:
+            self._fhandle.close()
+            self._fhandle = None
+        except Exception as e:
+            raise e
+
+def archive_frames(reader, filename, chunk_frames=32, codec='zlib', level=None,
+bpr_header=None):
+    '''Write all frames of reader, e.g. a BprReader or RawReader, to the
+    archive file filename. Return the number of frames written.'''
+    first = reader.get_frames([0]) if reader.nframes > 0 else None
+    (h, w) = first.shape[1:] if first is not None else (0, 0)
+    with ArchiveWriter(filename, h, w, dtype=reader.dtype,
+                       chunk_frames=chunk_frames, codec=codec, level=level,
+                       bpr_header=bpr_header) as writer:
+        for start in range(0, reader.nframes, chunk_frames):
+            stop = min(start + chunk_frames, reader.nframes)
+            writer.write(reader.get_frames(slice(start, stop)))
+    return writer.nframes
+
+def archive_bpr(bprfile, filename=None, chunk_frames=32, codec='zlib',
+level=None):
+    '''Write the frames and header of a .bpr file to an archive. The default
+    archive filename is the .bpr filename with ARCHIVE_EXT appended. Return
+    the archive filename.'''
+    if filename is None:
+        filename = bprfile + ARCHIVE_EXT
+    with open(bprfile, 'rb') as f:
+        bpr_header = f.read(BPR_HDR_SIZE)
+    rdr = BprReader(bprfile, memmap=True)
+    archive_frames(rdr, filename, chunk_frames, codec, level, bpr_header)
+    return filename
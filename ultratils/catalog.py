@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+# Persistent catalog of acquisition metadata in an SQLite database.
+
+# The catalog has one row per acquisition in the acquisitions table, which
+# holds the metadata gathered by Acq.gather() along with the acquisition
+# path and a modification time that is used to decide whether the row is
+# stale. The runtime variables of each acquisition are stored as
+# (timestamp, name, val) rows in the runtime_vars table. The columns that
+# are commonly used in queries are indexed.
+
+import os
+import json
+import sqlite3
+
+# Version of the database schema. Catalogs with another version are
+# discarded and rebuilt.
+CATALOG_VERSION = 1
+
+# Columns of the acquisitions table.
+ACQ_COLUMNS = (
+    ('timestamp', 'TEXT PRIMARY KEY'),
+    ('utc', 'TEXT'),
+    ('abspath', 'TEXT'),
+    ('dtype', 'TEXT'),
+    ('stimulus', 'TEXT'),
+    ('n_frames', 'INTEGER'),
+    ('image_h', 'INTEGER'),
+    ('image_w', 'INTEGER'),
+    ('probe', 'INTEGER'),
+    ('n_pulse_idx', 'INTEGER'),
+    ('n_raw_data_idx', 'INTEGER'),
+    ('pulse_min', 'REAL'),
+    ('pulse_max', 'REAL'),
+    ('imaging_params', 'TEXT'),
+    ('versions', 'TEXT'),
+    ('mtime', 'REAL'),
+    ('error', 'TEXT'),
+)
+ACQ_COLUMN_NAMES = tuple(c[0] for c in ACQ_COLUMNS)
+
+# Indexed columns of the acquisitions table.
+INDEXED_COLUMNS = ('utc', 'stimulus', 'n_frames', 'image_h', 'image_w', 'probe')
+
+class Catalog(object):
+    '''An SQLite catalog of acquisition metadata.
+
+    Parameters
+    ----------
+    filename : str
+    The name of the database file. It is created if it does not exist.
+    '''
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._conn = sqlite3.connect(self.filename)
+        self._conn.row_factory = sqlite3.Row
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            with self._conn:
+                self._conn.execute('DROP TABLE IF EXISTS acquisitions')
+                self._conn.execute('DROP TABLE IF EXISTS runtime_vars')
+                self._conn.execute('DROP TABLE IF EXISTS meta')
+                self._create()
+                self._conn.execute(
+                    'PRAGMA user_version = {:d}'.format(CATALOG_VERSION)
+                )
+
+    def _create(self):
+        '''Create the tables and indexes.'''
+        cols = ', '.join('{:} {:}'.format(n, t) for n, t in ACQ_COLUMNS)
+        self._conn.execute('CREATE TABLE acquisitions ({:})'.format(cols))
+        for col in INDEXED_COLUMNS:
+            self._conn.execute(
+                'CREATE INDEX acq_{0:} ON acquisitions ({0:})'.format(col)
+            )
+        self._conn.execute(
+            'CREATE TABLE runtime_vars (timestamp TEXT, name TEXT, val TEXT, '
+            'PRIMARY KEY (timestamp, name))'
+        )
+        self._conn.execute(
+            'CREATE INDEX runtime_vars_name_val ON runtime_vars (name, val)'
+        )
+        self._conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, val TEXT)')
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def get_meta(self, key):
+        '''Return the catalog metadata value stored for key, or None.'''
+        row = self._conn.execute(
+            'SELECT val FROM meta WHERE key = ?', (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, val):
+        '''Store a catalog metadata value for key.'''
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO meta (key, val) VALUES (?, ?)', (key, val)
+            )
+
+    def mtimes(self):
+        '''Return a dict that maps the timestamps of all cataloged
+        acquisitions to their stored modification times.'''
+        return dict(
+            (row[0], row[1]) for row in
+            self._conn.execute('SELECT timestamp, mtime FROM acquisitions')
+        )
+
+    def store(self, rows):
+        '''Insert or replace acquisitions. rows is a sequence of
+        (values, runtime_vars) tuples, where values is a dict of
+        acquisitions table values and runtime_vars is a sequence of
+        (name, val) tuples. The imaging_params value may be a dict.'''
+        insert = 'INSERT OR REPLACE INTO acquisitions ({:}) VALUES ({:})'.format(
+            ', '.join(ACQ_COLUMN_NAMES), ', '.join('?' * len(ACQ_COLUMN_NAMES))
+        )
+        with self._conn:
+            for values, runtime_vars in rows:
+                values = dict(values)
+                if isinstance(values.get('imaging_params'), dict):
+                    values['imaging_params'] = json.dumps(values['imaging_params'])
+                self._conn.execute(
+                    insert, [values.get(c) for c in ACQ_COLUMN_NAMES]
+                )
+                self._conn.execute(
+                    'DELETE FROM runtime_vars WHERE timestamp = ?',
+                    (values['timestamp'],)
+                )
+                self._conn.executemany(
+                    'INSERT INTO runtime_vars (timestamp, name, val) '
+                    'VALUES (?, ?, ?)',
+                    [(values['timestamp'], n, v) for n, v in runtime_vars]
+                )
+
+    def remove(self, timestamps):
+        '''Remove the acquisitions with the given timestamps.'''
+        with self._conn:
+            for ts in timestamps:
+                self._conn.execute(
+                    'DELETE FROM acquisitions WHERE timestamp = ?', (ts,)
+                )
+                self._conn.execute(
+                    'DELETE FROM runtime_vars WHERE timestamp = ?', (ts,)
+                )
+
+    def get(self, timestamp):
+        '''Return the catalog row of the acquisition with timestamp as a
+        dict, or None if it is not in the catalog.'''
+        rows = self._rows(
+            'SELECT * FROM acquisitions WHERE timestamp = ?', [timestamp]
+        )
+        return rows[0] if len(rows) > 0 else None
+
+    def find(self, **criteria):
+        '''Return a list of dicts with the catalog rows of the acquisitions
+        that match all of the criteria, ordered by time.
+
+        Criteria with the name of a column of the acquisitions table select
+        on that column; any other criterion selects on the runtime variable
+        of that name. A criterion value may be a single value, None to
+        match missing values, or a list or tuple of values to match any of.
+        '''
+        where = []
+        params = []
+        for name, val in sorted(criteria.items()):
+            if name in ACQ_COLUMN_NAMES:
+                (cond, vparams) = _match(name, val)
+            else:
+                (cond, vparams) = _match('val', val)
+                cond = 'timestamp IN (SELECT timestamp FROM runtime_vars ' \
+                       'WHERE name = ? AND {:})'.format(cond)
+                vparams = [name] + vparams
+            where.append(cond)
+            params.extend(vparams)
+        sql = 'SELECT * FROM acquisitions'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self._rows(sql + ' ORDER BY utc', params)
+
+    def _rows(self, sql, params):
+        '''Run a query on the acquisitions table and return the rows as dicts
+        with their runtime variables in a 'runtime_vars' list.'''
+        rows = [dict(r) for r in self._conn.execute(sql, params)]
+        for row in rows:
+            if row['imaging_params'] is not None:
+                row['imaging_params'] = json.loads(row['imaging_params'])
+            row['runtime_vars'] = [
+                (r[0], r[1]) for r in self._conn.execute(
+                    'SELECT name, val FROM runtime_vars WHERE timestamp = ? '
+                    'ORDER BY rowid',
+                    (row['timestamp'],)
+                )
+            ]
+        return rows
+
+def _match(col, val):
+    '''Return an SQL condition and its parameters for matching col to val.'''
+    if val is None:
+        return ('{:} IS NULL'.format(col), [])
+    elif isinstance(val, (list, tuple)):
+        return (
+            '{:} IN ({:})'.format(col, ', '.join('?' * len(val))), list(val)
+        )
+    return ('{:} = ?'.format(col), [val])
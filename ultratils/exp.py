@@ -2,11 +2,12 @@
 
 import os, sys
 import re
-from datetime import datetime
+import concurrent.futures
+from datetime import datetime, timedelta
 from dateutil.tz import tzlocal
 import numpy as np
-import pandas as pd
-from ultratils.acq import Acq
+from ultratils.acq import Acq, read_runtime_var_names, GATHER_ATTRS
+from ultratils.catalog import Catalog
 
 # Regex that matches a timezone offset at the end of an acquisition directory
 # name.
@@ -14,6 +15,9 @@ utcoffsetre = re.compile(r'(?P<offset>(?P<sign>[-+])(?P<hours>0\d|1[12])(?P<minu
 
 tstamp_format = '%Y-%m-%dT%H%M%S'
 
+# Default name of the catalog database file in the experiment directory.
+CATALOG_NAME = '.ultratils_catalog.sqlite'
+
 # TODO: use pandas Timestamp to do all datetime handling?
 
 # TODO: remove? rename?
@@ -42,6 +46,16 @@ Raise an ExpError if the string is not verified.
     except ValueError:
         raise ExpError("Incorrect timestamp for path {:}".format(s))
 
+def utc_datetime(s):
+    """Return the naive UTC datetime of an Acq timestamp string."""
+    m = utcoffsetre.search(s)
+    offset = timedelta(
+        hours=int(m.group('hours')), minutes=int(m.group('minutes'))
+    )
+    if m.group('sign') == '-':
+        offset = -offset
+    return datetime.strptime(utcoffsetre.sub('', s), tstamp_format) - offset
+
 class ExpError(Exception):
     """Base class for errors in this module."""
     def __init__(self, msg):
@@ -49,49 +63,302 @@ class ExpError(Exception):
     def __str__(self):
         return repr(self.msg)
 
+def _load_acq(timestamp, expdir, abspath, dtype, params_file):
+    """Gather the metadata of an acquisition in a worker process and return
+it as a dict of the attributes set by Acq.gather()."""
+    a = Acq(timestamp=timestamp, expdir=expdir, abspath=abspath, dtype=dtype)
+    a.gather(params_file)
+    return dict((name, getattr(a, name)) for name in GATHER_ATTRS)
+
+def acq_mtime(abspath):
+    """Return the latest modification time of an acquisition directory and
+the files in it, or None if the directory cannot be read."""
+    try:
+        mtime = os.stat(abspath).st_mtime
+        for entry in os.scandir(abspath):
+            mtime = max(mtime, entry.stat().st_mtime)
+    except OSError:
+        return None
+    return mtime
+
+def _num(val, conv):
+    """Convert val with conv for storage in the catalog, keeping None."""
+    return None if val is None else conv(val)
+
+class ExpIndex():
+    """An index of the acquisition directories in an experiment.
+
+The experiment directory tree is scanned once, on construction and on each
+call to refresh(), and every directory whose name is an acquisition
+timestamp is recorded. Acquisition directories are not searched for further
+acquisitions. The runtime variable names of the experiment are read from
+runtime_vars.txt once, when first needed.
+"""
+
+    def __init__(self, expdir):
+        self.abspath = os.path.abspath(expdir)
+        self.paths = {}
+        self._runtime_var_names = None
+        self.refresh()
+
+    def refresh(self):
+        """Rescan the experiment directory."""
+        paths = {}
+        dirs = [self.abspath]
+        try:   # the experiment directory may itself be an acquisition
+            is_timestamp(os.path.basename(self.abspath))
+            paths[os.path.basename(self.abspath)] = self.abspath
+            dirs = []
+        except ExpError:
+            pass
+        while len(dirs) > 0:
+            mydir = dirs.pop()
+            try:
+                entries = list(os.scandir(mydir))
+            except OSError:   # unreadable or removed during the scan
+                continue
+            for entry in entries:
+                # Symbolic links are not followed, as in os.walk(), so that
+                # link loops cannot make the scan recurse without end.
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                except OSError:
+                    continue
+                try:
+                    is_timestamp(entry.name)
+                except ExpError:
+                    dirs.append(entry.path)
+                    continue
+                paths.setdefault(entry.name, os.path.normpath(entry.path))
+        self.paths = paths
+        self._runtime_var_names = None
+
+    @property
+    def timestamps(self):
+        """The timestamps of the indexed acquisitions."""
+        return list(self.paths.keys())
+
+    def path(self, timestamp):
+        """Return the absolute path of the acquisition directory for timestamp,
+or None if it is not in the index."""
+        return self.paths.get(timestamp)
+
+    def runtime_var_names(self):
+        """Return the list of runtime variable names in runtime_vars.txt.
+Raise IOError if the experiment has no runtime_vars.txt."""
+        if self._runtime_var_names is None:
+            self._runtime_var_names = read_runtime_var_names(
+                os.path.join(self.abspath, 'runtime_vars.txt')
+            )
+        return self._runtime_var_names
+
 class Exp():
-    """An ultrasound experiment."""
+    """An ultrasound experiment.
 
-    def __init__(self, expdir=None):
+expdir = the root experiment directory
+catalog = optional name of an SQLite catalog file for the experiment's
+  acquisition metadata, or True to use CATALOG_NAME in expdir; see
+  refresh_catalog() and query()
+"""
+
+    def __init__(self, expdir=None, catalog=None):
         self.expdir = os.path.normpath(expdir)
         self.abspath = os.path.abspath(self.expdir)
         self.relpath = self.abspath.replace(self.expdir, '')
         self.acquisitions = []
         self.timestamps = []
-        self._image_converter = None
+        self.index = None
+        self.errors = {}
+        self._acqs = {}      # all Acqs created, by timestamp
+        self._listed = set()   # timestamps of the Acqs in acquisitions
+        if catalog is True:
+            catalog = os.path.join(self.abspath, CATALOG_NAME)
+        self.catalog = None if catalog is None else Catalog(catalog)
+
+    def gather(self, load=False, workers=1, processes=False, progress=None,
+params_file='params.cfg'):
+        """Gather the acquisitions in the experiment.
 
-    def gather(self):
-        """Gather the acquisitions in the experiment."""
+load = if True, also load the metadata of each new acquisition, and of each
+  acquisition that could not be loaded before, with Acq.gather()
+workers = number of acquisitions to load concurrently
+processes = if True, load acquisitions in worker processes instead of
+  threads; use this when parsing rather than I/O dominates
+progress = optional callable progress(ndone, ntotal, acq, error) that is
+  called as each acquisition is loaded; error is None or the exception
+  raised while loading acq
+params_file = name of the imaging parameters file passed to Acq.gather()
+
+An error raised while loading an acquisition does not stop the others from
+being loaded. It is stored in the errors attribute, a dict that maps the
+timestamps of acquisitions that could not be loaded to their exceptions.
+"""
         re_sort = False
-        for mydir, subdirs, files in os.walk(self.abspath):
-            ts = os.path.split(mydir)[-1]
-            if ts not in self.timestamps:
-                try:
-                    is_timestamp(ts)
-                except ExpError:
-                    continue
-                self.acquisitions.append(
-                    Acq(
+        new = set()
+        if self.index is None:
+            self.index = ExpIndex(self.abspath)
+        else:
+            self.index.refresh()
+        for ts, mydir in self.index.paths.items():
+            if ts not in self._listed:
+                a = self._acqs.get(ts)   # may have been created by query()
+                if a is None:
+                    a = Acq(
                         timestamp=ts,
                         expdir=self.abspath,
-                        abspath=os.path.abspath(mydir),
-                        image_converter=self._image_converter
+                        abspath=mydir,
+                        index=self.index
                     )
-                )
-# TODO: there should be error checking of image size here and/or in Acq()
-                if self._image_converter is None:
-                    a = self.acquisitions[0]
-                    self._image_converter = a.image_converter
+                    self._acqs[ts] = a
+                self.acquisitions.append(a)
                 self.timestamps.append(ts)
+                self._listed.add(ts)
+                new.add(ts)
                 re_sort = True
         if re_sort is True:
-            self.acquisitions.sort(key=lambda a: pd.to_datetime(a.timestamp))
+            self.acquisitions.sort(key=lambda a: utc_datetime(a.timestamp))
+        if load is True:
+            acqs = [
+                a for a in self.acquisitions
+                if a.timestamp in new or a.timestamp in self.errors
+            ]
+            self._load(acqs, workers, processes, progress, params_file)
+
+    def _load(self, acqs, workers, processes, progress, params_file):
+        """Load the metadata of acqs concurrently."""
+        if processes is True:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            futures = {}
+            for a in acqs:
+                if processes is True:
+                    f = pool.submit(
+                        _load_acq, a.timestamp, a.expdir, a.abspath, a.dtype,
+                        params_file
+                    )
+                else:
+                    f = pool.submit(a.gather, params_file)
+                futures[f] = a
+            for ndone, f in enumerate(concurrent.futures.as_completed(futures), 1):
+                a = futures[f]
+                error = f.exception()
+                if error is None:
+                    self.errors.pop(a.timestamp, None)
+                    if processes is True:
+                        for name, val in f.result().items():
+                            setattr(a, name, val)
+                else:
+                    self.errors[a.timestamp] = error
+                if progress is not None:
+                    progress(ndone, len(acqs), a, error)
 
     def get_acq(self, timestamp):
-        """Get an acquisition based on its timestamp."""
-        acq = None
+        """Get an acquisition based on its timestamp. If it has not been
+gathered but is in the catalog, it is created from its catalog row. Return
+None if the acquisition is not found."""
+        a = self._acqs.get(timestamp)
+        if a is None and self.catalog is not None:
+            row = self.catalog.get(timestamp)
+            if row is not None:
+                a = self._cataloged_acq(row)
+        return a
+
+    def _cataloged_acq(self, row):
+        """Return the Acq for a catalog row, creating it with the metadata of
+the row if it does not exist yet."""
+        a = self._acqs.get(row['timestamp'])
+        if a is None:
+            a = Acq(
+                timestamp=row['timestamp'],
+                expdir=self.abspath,
+                dtype=row['dtype'],
+                abspath=row['abspath'],
+                index=self.index,
+                runtime_vars=row['runtime_vars']
+            )
+            self._acqs[row['timestamp']] = a
+        if row['error'] is None and not hasattr(a, 'n_frames'):
+            for name in GATHER_ATTRS:
+                setattr(a, name, row['probe' if name == 'probe_id' else name])
+        return a
+
+    def refresh_catalog(self, workers=1, processes=False, progress=None,
+params_file='params.cfg'):
+        """Gather the acquisitions in the experiment and bring the catalog up to
+date. Only acquisitions that are new, that have files that were modified
+since they were cataloged, or that could not be loaded before are loaded
+with Acq.gather(); the others keep their catalog rows. Acquisitions that no
+longer exist are removed from the catalog. See gather() for the parameters.
+
+Return the list of timestamps of the acquisitions that were loaded. Raise
+ExpError if the experiment has no catalog.
+"""
+        if self.catalog is None:
+            raise ExpError('The experiment has no catalog.')
+        self.gather()
+        stored = self.catalog.mtimes()
+        try:
+            rvmtime = repr(os.stat(
+                os.path.join(self.abspath, 'runtime_vars.txt')
+            ).st_mtime)
+        except OSError:
+            rvmtime = None
+        if rvmtime != self.catalog.get_meta('runtime_vars_mtime'):
+            stored = {}   # runtime variable names may have changed
+        mtimes = {}
+        stale = []
         for a in self.acquisitions:
-            if a.timestamp == timestamp:
-                acq = a
-                break
-        return acq
+            mtimes[a.timestamp] = acq_mtime(a.abspath)
+            m = stored.get(a.timestamp)
+            if m is None or m != mtimes[a.timestamp]:
+                stale.append(a)
+        self._load(stale, workers, processes, progress, params_file)
+        rows = []
+        for a in stale:
+            error = self.errors.get(a.timestamp)
+            values = {
+                'timestamp': a.timestamp,
+                'utc': utc_datetime(a.timestamp).isoformat(),
+                'abspath': a.abspath,
+                'dtype': a.dtype,
+                # Failed acquisitions are stored without an mtime so that they
+                # are loaded again by the next refresh.
+                'mtime': None if error is not None else mtimes[a.timestamp],
+                'error': None if error is None else repr(error),
+            }
+            if error is None:
+                values.update({
+                    'stimulus': a.stimulus,
+                    'n_frames': _num(a.n_frames, int),
+                    'image_h': _num(a.image_h, int),
+                    'image_w': _num(a.image_w, int),
+                    'probe': _num(a.probe_id, int),
+                    'n_pulse_idx': _num(a.n_pulse_idx, int),
+                    'n_raw_data_idx': _num(a.n_raw_data_idx, int),
+                    'pulse_min': _num(a.pulse_min, float),
+                    'pulse_max': _num(a.pulse_max, float),
+                    'imaging_params': a.imaging_params,
+                    'versions': a.versions,
+                })
+            runtime_vars = [(v.name, v.val) for v in (a.runtime_vars or [])]
+            rows.append((values, runtime_vars))
+        self.catalog.store(rows)
+        self.catalog.remove(set(self.catalog.mtimes()) - set(mtimes))
+        self.catalog.set_meta('runtime_vars_mtime', rvmtime)
+        return [a.timestamp for a in stale]
+
+    def query(self, **criteria):
+        """Return a list of the cataloged acquisitions that match criteria,
+ordered by time, without reading their metadata files. See
+ultratils.catalog.Catalog.find() for the criteria; e.g.
+query(stimulus='ba', speaker='s01') finds the acquisitions with stimulus
+'ba' and runtime variable speaker 's01'. Acquisitions that are not yet in
+the experiment's acquisitions list are created with the metadata from the
+catalog. Raise ExpError if the experiment has no catalog.
+"""
+        if self.catalog is None:
+            raise ExpError('The experiment has no catalog.')
+        return [self._cataloged_acq(row) for row in self.catalog.find(**criteria)]
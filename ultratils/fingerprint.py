@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Fast detection of duplicate and frozen image frames.
+
+# Frames are compared by cheap fingerprints that are calculated for a whole
+# stack of frames at once: the wrapping sum and the xor of the frame data
+# taken as 64-bit words. Frames with different fingerprints cannot be equal.
+# Frames with equal fingerprints are compared exactly before they are
+# reported as duplicates, so fingerprint collisions never cause false
+# positives.
+
+import numpy as np
+
+# Odd 64-bit multiplier used to mix the two fingerprint components.
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def fingerprints(frames):
+    '''Return a 1D uint64 ndarray with one fingerprint for each frame in
+    frames, which is an (n, ...) ndarray or memmap of frame data.'''
+    n = len(frames)
+    data = np.ascontiguousarray(frames).reshape(n, -1).view(np.uint8)
+    if data.shape[1] % 8 != 0:   # pad frames to a whole number of words
+        padded = np.zeros([n, data.shape[1] + 8 - data.shape[1] % 8], np.uint8)
+        padded[:, :data.shape[1]] = data
+        data = padded
+    words = data.view(np.uint64)
+    with np.errstate(over='ignore'):
+        wsum = words.sum(axis=1, dtype=np.uint64)
+        wxor = np.bitwise_xor.reduce(words, axis=1)
+        return (wsum * _MIX) ^ wxor
+
+def _exact_groups(frames, idxs):
+    '''Split a list of frame indexes with the same fingerprint into groups
+    of exactly equal frames.'''
+    groups = []
+    for idx in idxs:
+        for grp in groups:
+            if np.array_equal(frames[grp[0]], frames[idx]):
+                grp.append(idx)
+                break
+        else:
+            groups.append([idx])
+    return groups
+
+def duplicate_groups(frames, fprints=None):
+    '''Find sets of identical frames in frames.
+
+    Return a list of lists of frame indexes. Each list contains the indexes
+    of two or more identical frames in increasing order. fprints are the
+    frame fingerprints and are calculated if not provided.
+    '''
+    if fprints is None:
+        fprints = fingerprints(frames)
+    index = {}
+    for idx, fp in enumerate(fprints.tolist()):
+        index.setdefault(fp, []).append(idx)
+    groups = []
+    for idxs in index.values():
+        if len(idxs) > 1:
+            groups.extend(g for g in _exact_groups(frames, idxs) if len(g) > 1)
+    groups.sort()
+    return groups
+
+def duplicates(frames, fprints=None):
+    '''Return a 1D int ndarray in which each element holds the index of the
+    first frame that is identical to the corresponding frame in frames, or
+    -1 if the frame does not duplicate an earlier frame.'''
+    orig = np.full(len(frames), -1, dtype=int)
+    for grp in duplicate_groups(frames, fprints):
+        orig[grp[1:]] = grp[0]
+    return orig
+
+def frozen_runs(frames, fprints=None):
+    '''Find runs of consecutive identical (frozen) frames.
+
+    Return a list of (start, stop) tuples such that frames[start:stop] are
+    identical and stop - start > 1.
+    '''
+    if fprints is None:
+        fprints = fingerprints(frames)
+    same = np.zeros(len(fprints), dtype=bool)   # same[i]: frame i == frame i-1
+    for idx in np.nonzero(fprints[1:] == fprints[:-1])[0] + 1:
+        same[idx] = np.array_equal(frames[idx - 1], frames[idx])
+    bounded = np.hstack(([0], same.astype(int), [0]))
+    difs = np.diff(bounded)
+    run_starts = np.nonzero(difs == 1)[0] - 1
+    run_ends = np.nonzero(difs == -1)[0]
+    return list(zip(run_starts.tolist(), run_ends.tolist()))
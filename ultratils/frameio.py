@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+# Low-level helpers shared by the image frame readers.
+
+import os
+import time
+import threading
+try:
+    import queue
+except ImportError:   # Python 2
+    import Queue as queue
+import numpy as np
+
+# Positional reads. These read at an absolute offset without using or moving
+# the file position of the handle, which makes them safe to use concurrently
+# from multiple threads on a single handle. Where the OS does not provide
+# pread() we fall back to seek() and read() while holding the reader's lock.
+
+def pread(fhandle, size, offset, lock):
+    '''Return up to size bytes read from fhandle at offset.'''
+    if hasattr(os, 'pread'):
+        return os.pread(fhandle.fileno(), size, offset)
+    with lock:
+        fhandle.seek(offset)
+        return fhandle.read(size)
+
+def preadinto(fhandle, buf, offset, lock):
+    '''Read from fhandle at offset into the writable buffer buf until it is
+    full or the end of file is reached. Return the number of bytes read.'''
+    buf = memoryview(buf).cast('B')
+    nread = 0
+    while nread < len(buf):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fhandle.fileno(), [buf[nread:]], offset + nread)
+        elif hasattr(os, 'pread'):
+            data = os.pread(fhandle.fileno(), len(buf) - nread, offset + nread)
+            n = len(data)
+            buf[nread:nread + n] = data
+        else:
+            with lock:
+                fhandle.seek(offset + nread)
+                n = fhandle.readinto(buf[nread:])
+        if n == 0:
+            break
+        nread += n
+    return nread
+
+def as_indices(idx, nframes):
+    '''Return idx as a 1D ndarray of non-negative frame indexes.
+
+    idx may be a slice, a range, an int, or a sequence or ndarray of ints.
+    Negative indexes count back from nframes. Raise IndexError for indexes
+    that are out of range.
+    '''
+    if isinstance(idx, slice):
+        return np.arange(*idx.indices(nframes), dtype=np.intp)
+    idx = np.array(idx, dtype=np.intp, ndmin=1).ravel()
+    idx[idx < 0] += nframes
+    bad = (idx < 0) | (idx >= nframes)
+    if np.any(bad):
+        raise IndexError('{:}'.format(idx[bad][0]))
+    return idx
+
+def index_runs(indices):
+    '''Group frame indexes into runs of consecutive frames.
+
+    Return a tuple (runs, inverse). runs is a list of (start, stop) tuples
+    that together cover each of the unique values of indices once, in
+    increasing order. inverse maps the concatenation of the runs back to
+    the order of indices, i.e. if `frames` contains the frames of the runs
+    in order, then `frames[inverse]` contains the frames of indices.
+    inverse is None if no reordering is needed.
+    '''
+    if len(indices) == 0:
+        return ([], None)
+    if np.all(np.diff(indices) == 1):
+        return ([(indices[0], indices[-1] + 1)], None)
+    uniq, inverse = np.unique(indices, return_inverse=True)
+    breaks = np.nonzero(np.diff(uniq) != 1)[0] + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(uniq)]))
+    runs = [(uniq[a], uniq[b - 1] + 1) for a, b in zip(starts, stops)]
+    return (runs, inverse)
+
+def read_frames(fhandle, indices, data_offset, framesize, dtype, lock):
+    '''Read the frames in indices from fhandle with one positional read per
+    run of consecutive frames, and return them as a 2D ndarray with one row
+    of raw frame data per index.
+    '''
+    (runs, inverse) = index_runs(indices)
+    nframes = sum(stop - start for start, stop in runs)
+    buf = np.empty([nframes, framesize // np.dtype(dtype).itemsize], dtype=dtype)
+    row = 0
+    for start, stop in runs:
+        dest = buf[row:row + stop - start].view(np.uint8).reshape(-1)
+        offset = data_offset + (start * framesize)
+        if preadinto(fhandle, dest, offset, lock) != len(dest):
+            raise IndexError('{:}'.format(stop - 1))
+        row += stop - start
+    if inverse is not None:
+        buf = buf[inverse]
+    return buf
+
+def frames_out(out, shape, dtype):
+    '''Return out if it is a usable output buffer for frames of shape and
+    dtype, or a new ndarray if out is None. Raise ValueError otherwise.'''
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if tuple(out.shape) != tuple(shape):
+        msg = 'Output buffer has shape {:}; expected {:}.'
+        raise ValueError(msg.format(out.shape, tuple(shape)))
+    return out
+
+def follow(reader, start=0, poll_interval=0.1, timeout=None, until=None):
+    '''Yield frames from reader as they are appended to its file.
+
+    This is a generator that yields each frame of reader in order,
+    beginning at frame index start. When it runs out of frames it calls
+    `reader.refresh()` every poll_interval seconds to pick up complete
+    frames that have been written since the last check.
+
+    The generator stops when no new frames have arrived for timeout seconds,
+    or, if until is provided, when the callable until() returns True and
+    all frames on disk have been yielded. If both timeout and until are
+    None the generator waits for new frames indefinitely.
+    '''
+    idx = start
+    last_frame_time = time.time()
+    while True:
+        done = until is not None and until()
+        nframes = reader.refresh()
+        if idx < nframes:
+            for frame in reader.get_frames(slice(idx, nframes)):
+                yield frame
+            idx = nframes
+            last_frame_time = time.time()
+        elif done:
+            return
+        elif timeout is not None and time.time() - last_frame_time >= timeout:
+            return
+        else:
+            time.sleep(poll_interval)
+
+class Prefetcher(object):
+    '''Iterator that reads frames ahead of the consumer in a background
+    thread.
+
+    The frames in indices are read from reader in order into a fixed pool
+    of depth + 1 preallocated frame buffers, so that reading the next
+    frames from disk overlaps with whatever the consumer does with the
+    current one.
+
+    Each frame returned by the iterator is a buffer from the pool and is
+    only valid until the next frame is requested. Copy it if it needs to be
+    kept.
+
+    Counters
+    --------
+
+    stalls : int
+    The number of times the consumer had to wait for a frame to be read.
+
+    producer_stalls : int
+    The number of times the background thread had to wait for the consumer
+    to release a buffer, i.e. the number of times the queue was full.
+
+    max_depth : int
+    The largest number of frames that were waiting in the queue.
+
+    depth : int (read-only property)
+    The number of frames currently waiting in the queue.
+    '''
+    def __init__(self, reader, indices, shape, dtype, depth=8):
+        self.reader = reader
+        self.indices = indices
+        self.stalls = 0
+        self.producer_stalls = 0
+        self.max_depth = 0
+        self._pool = np.empty([depth + 1] + list(shape), dtype=dtype)
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for bufidx in range(depth + 1):
+            self._free.put(bufidx)
+        self._held = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self._filled.qsize()
+
+    def _produce(self):
+        '''Read frames into free buffers until done or stopped.'''
+        try:
+            for idx in self.indices:
+                try:
+                    bufidx = self._free.get_nowait()
+                except queue.Empty:
+                    self.producer_stalls += 1
+                    bufidx = None
+                    while bufidx is None and not self._stop.is_set():
+                        try:
+                            bufidx = self._free.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+                if self._stop.is_set():
+                    return
+                self.reader.get_frames([idx], out=self._pool[bufidx:bufidx + 1])
+                self._filled.put(bufidx)
+                self.max_depth = max(self.max_depth, self._filled.qsize())
+            self._filled.put(StopIteration())
+        except Exception as e:
+            self._filled.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._held is not None:
+            self._free.put(self._held)
+            self._held = None
+        try:
+            item = self._filled.get_nowait()
+        except queue.Empty:
+            self.stalls += 1
+            item = self._filled.get()
+        if isinstance(item, Exception):
+            self._filled.put(item)   # keep raising on later calls
+            raise item
+        self._held = item
+        return self._pool[item]
+
+    next = __next__
+
+    def close(self):
+        '''Stop the background thread.'''
+        self._stop.set()
+        self._thread.join()
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,7 +3,6 @@ import sys
 import numpy as np
 import wave
 from contextlib import closing
-import audiolabel
 
 # Algorithms to detect synchronization pulses.
 
@@ -77,8 +76,11 @@ algorithm = name of sync algorithm
 received_indexes = filename of an index file containing the indexes of the
    data frames received during acquisition
 outbasename = basename for output synchronization files, which will consist of
-   outbasename + '.sync.(txt|TextGrid)'
+   outbasename + '.sync.(txt|TextGrid|npz)'; the .npz file holds a SyncIndex
+   of the intervals in the TextGrid
 '''
+    import audiolabel
+    from ultratils.syncindex import SyncIndex
     (syncsig, rate) = loadsync(wavname, chan)
     if algorithm == 'impulse':
         syncsamp = sync_impulse(syncsig)
@@ -103,6 +105,13 @@ outbasename = basename for output synchronization files, which will consist of
     outname = wavname.replace('.ch1.wav', '').replace('.ch2.wav','').replace('.wav','')
     txtname = outbasename + '.sync.txt'
     tgname = outbasename + '.sync.TextGrid'
+    npzname = outbasename + '.sync.npz'
+    # Intervals of the SyncIndex, with -1 for intervals without a pulse or
+    # data frame.
+    ints_t1 = [0.0]
+    ints_t2 = [synctimes[0]]
+    ints_pulse = [-1]
+    ints_data = [-1]
     lm = audiolabel.LabelManager()
     pulse_tier = audiolabel.IntervalTier(name="pulse_idx", start=0.0,
                                          end=np.round(len(syncsig) / rate, decimals=4))
@@ -140,6 +149,10 @@ outbasename = basename for output synchronization files, which will consist of
             pulse_tier.add(audiolabel.Label(t1=t1, t2=t2, text=str(idx)))
             if received_indexes is not None:
                 raw_data_tier.add(audiolabel.Label(t1=t1, t2=t2, text=str(dframe)))
+            ints_t1.append(t1)
+            ints_t2.append(t2)
+            ints_pulse.append(idx)
+            ints_data.append(dframe if received_indexes is not None and dframe != 'NA' else -1)
             t1 = t2
             last_frame += 1
     t2 = t1 + dtimes.min()
@@ -150,8 +163,13 @@ outbasename = basename for output synchronization files, which will consist of
         raw_data_tier.add(audiolabel.Label(t1=t1, t2=t2, text=''))
         if t2 > raw_data_tier.end:
             raw_data_tier.end = t2
+    ints_t1.append(t1)
+    ints_t2.append(t2)
+    ints_pulse.append(-1)
+    ints_data.append(-1)
     with open(tgname, 'w') as tgout:
         tgout.write(lm.as_string(fmt="praat_long"))
+    SyncIndex(ints_t1, ints_t2, ints_data, ints_pulse).save(npzname)
  
 
 
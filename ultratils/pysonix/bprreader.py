@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
 import os
+import hashlib
 import struct
 import numpy as np
-import hashlib
+import sys
+import threading
+from ultratils.frameio import as_indices, read_frames, frames_out, preadinto, \
+    follow, Prefetcher
+from ultratils.fingerprint import fingerprints, duplicates
 
 class Header(object):
     def __init__(self, filehandle):
@@ -26,9 +31,44 @@ class Header(object):
                 idx += 1
 
 class BprReader:
-    def __init__(self, filename, checksum=False):
+    '''Class for reading .bpr (pre-scan converted B-mode) ultrasound data.
+
+    Parameters
+    ----------
+    filename : str
+    The name of the .bpr file to read.
+
+    Optional parameters
+    -------------------
+
+    checksum : bool (default False)
+    Calculate a SHA1 checksum for each frame on construction and report
+    duplicate frames. The checksums are stored as hex strings in the `csums`
+    attribute. Duplicates are found with the fast checksums of the
+    `fingerprints` property.
+
+    memmap : bool (default False)
+    If True, memory-map the data section of the file and return frames
+    from `get_frame()` and iteration as zero-copy uint8 views of the map
+    instead of reading and unpacking them from the file handle. The views
+    are read-only and remain valid for as long as they are referenced.
+
+    Thread safety
+    -------------
+
+    Frames are read with positional reads that neither use nor move a
+    shared file position, so `get_frame()`, `get_frames()` and iteration
+    may be called concurrently from multiple threads on a single reader.
+    When several threads iterate over the same reader each frame is
+    returned to exactly one of them. Do not call `close()` while other
+    threads are reading.
+    '''
+    def __init__(self, filename, checksum=False, memmap=False):
         self.filename = os.path.abspath(filename)
         self._fhandle = None
+        self._lock = threading.RLock()
+        self._data = None
+        self.memmap = memmap
         self.open()
         self.header = Header(self._fhandle)
         # TODO: when we have more image readers other than bpr, they all should
@@ -49,43 +89,165 @@ class BprReader:
         self.framesize = 1 * (self.header.h * self.header.w)
         self.csums = [None] * self.header.nframes
         if checksum:
-            for idx in range(self.header.nframes):
-                print("working on {:d}".format(idx))
-                data = self.get_frame()
-                csum = hashlib.sha1(data.copy(order="c")).hexdigest()
-                if csum in self.csums:
-                    "Frame {:d} is a duplicate!".format(idx)
-                self.csums[idx] = csum
+            # Frames that are not complete on disk keep a checksum of None.
+            for idx, frame in enumerate(self.data):
+                self.csums[idx] = hashlib.sha1(
+                    np.ascontiguousarray(frame.T)
+                ).hexdigest()
+            for idx, orig in enumerate(duplicates(self.data, self.fingerprints)):
+                if orig >= 0:
+                    msg = "Frame {:d} is a duplicate of {:d}!\n"
+                    sys.stderr.write(msg.format(idx, orig))
         self._fhandle.seek(self.header.packed_size)
         self._cursor = self._fhandle.tell()
         self.close()
 
+    @property
+    def data(self):
+        '''Return all image frames as a read-only (nframes, w, h) uint8
+        ndarray that is memory-mapped onto the data section of the file.
+        Frames are in file order, i.e. each frame is the transpose of what
+        `get_frame()` returns. Only complete frames present on disk are
+        included.'''
+        if self._data is None:
+            nframes = self._complete_frames()
+            shape = (nframes, self.header.w, self.header.h)
+            if nframes > 0:
+                self._data = np.memmap(
+                    self.filename, dtype=self.dtype, mode='r',
+                    offset=self.header.packed_size, shape=shape
+                )
+            else:   # mmap cannot map an empty region
+                self._data = np.zeros(shape, dtype=self.dtype)
+        return self._data
+
+    @property
+    def fingerprints(self):
+        '''Return a 1D uint64 ndarray of fast fingerprint checksums, one for
+        each complete frame. See ultratils.fingerprint for functions that use
+        these to find duplicate and frozen frames.'''
+        return fingerprints(self.data)
+
     def __iter__(self):
         return self
 
     def next(self):
         '''Get the next image frame.'''
-        if self._fhandle is None:
-            self.open()
-        try:
-            self._fhandle.seek(self._cursor)
-            packed_data = self._fhandle.read(self.framesize)
-            data = np.array(struct.unpack(self.data_fmt, packed_data))
-        except struct.error:   # ran out of data to unpack()
+        with self._lock:
+            cursor = self._cursor
+            self._cursor += self.framesize
+        if self.memmap:
+            idx = (cursor - self.header.packed_size) // self.framesize
+            if idx >= len(self.data):
+                self._rewind(cursor)
+                raise StopIteration
+            return self.data[idx].T
+        data = self._read_frame(cursor)
+        if data is None:   # ran out of data
+            self._rewind(cursor)
             raise StopIteration
-        self._cursor = self._fhandle.tell()
         return data.reshape([self.header.w, self.header.h]).T
+
+    __next__ = next
  
     def get_frame(self, idx=None):
         '''Get the image frame specified by idx. Do not advance the read location of _fhandle.'''
-        if self._fhandle is None:
-            self.open()
-        self._fhandle.seek(self.header.packed_size + (idx * self.framesize))
-        packed_data = self._fhandle.read(self.framesize)
-        self._fhandle.seek(self._cursor)
-        data = np.array(struct.unpack(self.data_fmt, packed_data))
+        if self.memmap:
+            return self.data[idx].T
+        offset = self.header.packed_size + (idx * self.framesize)
+        data = self._read_frame(offset)
+        if data is None:
+            raise IndexError('{:}'.format(idx))
         return data.reshape([self.header.w, self.header.h]).T
 
+    def get_frames(self, idx, out=None):
+        '''Get the image frames specified by idx and return them as a
+        contiguous (n, h, w) ndarray of the reader's dtype. idx may be a
+        slice, a range, or a sequence or ndarray of frame indexes in any
+        order. Neighboring frames are read from the file together. If out
+        is provided it must be an (n, h, w) array and is filled and returned.
+        Do not advance the read location of _fhandle.'''
+        indices = as_indices(idx, self.nframes)
+        shape = [len(indices), self.header.h, self.header.w]
+        out = frames_out(out, shape, self.dtype)
+        if self.memmap:
+            frames = self.data[indices]
+        else:
+            frames = read_frames(
+                self._handle(), indices, self.header.packed_size,
+                self.framesize, self.dtype, self._lock
+            )
+            frames = frames.reshape([len(indices), self.header.w, self.header.h])
+        out[...] = frames.transpose(0, 2, 1)
+        return out
+
+    def prefetch(self, idx=None, depth=8):
+        '''Return an iterator over the frames in idx (all frames if None)
+        that reads up to depth frames ahead in a background thread. Each
+        frame it returns is a buffer that is only valid until the next
+        frame is requested. The iterator has `stalls`, `producer_stalls`,
+        `depth` and `max_depth` counters; see ultratils.frameio.Prefetcher.
+        Only the complete frames present on disk can be prefetched, so a
+        truncated file yields the frames it has.'''
+        if idx is None:
+            idx = slice(None)
+        indices = as_indices(idx, self._complete_frames())
+        return Prefetcher(self, indices, [self.header.h, self.header.w], self.dtype, depth)
+
+    def refresh(self):
+        '''Re-read the header and update nframes with the number of complete
+        frames currently in the file, e.g. while ultracomm is still writing
+        it. The frame count in the header is not used because it might not
+        have been finalized yet. Return the new value of nframes.'''
+        with open(self.filename, 'rb') as fh:
+            self.header = Header(fh)
+        avail = os.path.getsize(self.filename) - self.header.packed_size
+        nframes = max(avail, 0) // self.framesize
+        with self._lock:
+            if nframes != self.nframes:
+                self._data = None   # remap on next access
+            self.nframes = nframes
+            self.header.nframes = nframes
+        return nframes
+
+    def follow(self, start=0, poll_interval=0.1, timeout=None, until=None):
+        '''Yield frames as they are appended to a .bpr file that is still
+        being written, beginning with frame index start.
+
+        poll_interval = seconds to wait between checks for new frames
+        timeout = stop when no new frames have arrived for this many seconds;
+          if None, wait indefinitely
+        until = optional callable; stop when it returns True and all frames
+          on disk have been yielded (e.g. when the acquisition process exits)
+        '''
+        return follow(self, start, poll_interval, timeout, until)
+
+    def _complete_frames(self):
+        '''Return the number of frames in the header that are complete on
+        disk.'''
+        avail = os.path.getsize(self.filename) - self.header.packed_size
+        return min(self.nframes, max(avail, 0) // self.framesize)
+
+    def _read_frame(self, offset):
+        '''Return the frame data at offset as a 1D array of the reader's
+        dtype, or None if there is not a complete frame at offset.'''
+        data = np.empty(self.framesize, dtype=self.dtype)
+        if preadinto(self._handle(), data, offset, self._lock) != self.framesize:
+            return None
+        return data
+
+    def _handle(self):
+        '''Return the open file handle, opening it if necessary.'''
+        with self._lock:
+            if self._fhandle is None:
+                self.open()
+            return self._fhandle
+
+    def _rewind(self, cursor):
+        '''Undo the cursor advance of a read at cursor that found no frame.'''
+        with self._lock:
+            self._cursor = min(self._cursor, cursor)
+
     def open(self):
         self._fhandle = open(self.filename, 'rb')
 
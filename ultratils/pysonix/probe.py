@@ -1,22 +1,176 @@
 #!/usr/bin/env python
 
+# Probe parameters from the Ultrasonix probes.xml file.
+
+# The probe file is parsed only once per process, into a ProbeTable that
+# holds the fields of every probe indexed by probe id and by probe name.
+# The fields of a probe are flattened into a dict keyed by the path of each
+# element below the <probe> element, e.g. 'pitch' or 'motor/radius', and
+# by 'path@attribute' for attributes, e.g. 'vendors/vendor@name'. The id and
+# name attributes of the <probe> element itself are keyed 'id' and 'name'.
+# Values are the element text or attribute value as strings; values of
+# paths that occur more than once in a probe are lists of strings.
+
+# If the ULTRATILS_CACHE_DIR environment variable names a cache directory,
+# the parsed table is stored there as JSON, keyed by a hash of the probe
+# file, so that other processes can load it without parsing the XML. JSON
+# rather than pickle is used because the cache directory may be shared, and
+# loading a pickle from it could run code written by anyone who can write
+# to it.
+
+import os
+import hashlib
+import json
+import tempfile
+import threading
 import xml.etree.ElementTree as ET
-import pkg_resources
+from ultratils.pysonix.tablecache import default_cache_dir
+
+# Version of the cached table format. Change this when the layout of the
+# ProbeTable fields changes to invalidate cached tables.
+TABLE_VERSION = 1
+
+_probe_table = None
+_probe_table_lock = threading.Lock()
+
+def _flatten(elem, path, fields):
+    '''Add the text and attributes of elem and its descendants to fields.'''
+    for child in elem:
+        cpath = child.tag if path == '' else path + '/' + child.tag
+        items = [('{:}@{:}'.format(cpath, k), v) for k, v in child.attrib.items()]
+        text = (child.text or '').strip()
+        if text != '' or len(child) == 0 and len(child.attrib) == 0:
+            items.append((cpath, text))
+        for (key, val) in items:
+            if key not in fields:
+                fields[key] = val
+            elif isinstance(fields[key], list):
+                fields[key].append(val)
+            else:
+                fields[key] = [fields[key], val]
+        _flatten(child, cpath, fields)
+
+def parse_probes(xml):
+    '''Parse the content of a probes.xml file and return a dict that maps
+    probe ids to dicts of probe fields.'''
+    by_id = {}
+    for probe in ET.fromstring(xml).iter('probe'):
+        fields = {'id': probe.get('id'), 'name': probe.get('name')}
+        _flatten(probe, '', fields)
+        by_id[fields['id']] = fields
+    return by_id
+
+class ProbeError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class ProbeTable(object):
+    '''Table of the fields of all probes in a probe file.
+
+    Some probe names are used by more than one probe id, e.g. C5-2/60, so
+    the by_name attribute maps each name to a list of the dicts of fields of
+    the probes with that name, in order of id.
+
+    Parameters
+    ----------
+    by_id : dict
+    A dict that maps probe ids (as strings) to dicts of probe fields, as
+    returned by parse_probes().
+    '''
+    def __init__(self, by_id):
+        self.by_id = by_id
+        self.by_name = {}
+        for f in sorted(by_id.values(), key=lambda f: int(f['id'])):
+            self.by_name.setdefault(f['name'], []).append(f)
+
+    def fields_for_id(self, id):
+        '''Return the dict of fields of the probe with id. Raise KeyError if
+        there is no such probe.'''
+        try:
+            return self.by_id[str(id)]
+        except KeyError:
+            raise KeyError("No probe with id '{:}'.".format(id))
+
+    def fields_for_name(self, name):
+        '''Return the dict of fields of the probe named name. Raise KeyError
+        if there is no such probe, and ProbeError if more than one probe has
+        that name.'''
+        try:
+            matches = self.by_name[name]
+        except KeyError:
+            raise KeyError("No probe named '{:}'.".format(name))
+        if len(matches) > 1:
+            msg = "Probe name '{:}' is ambiguous; it is used by probe ids {:}."
+            raise ProbeError(
+                msg.format(name, ', '.join(f['id'] for f in matches))
+            )
+        return matches[0]
+
+def _load_table(xml):
+    '''Return a ProbeTable for xml, from the cache if possible.'''
+    cachedir = default_cache_dir()
+    if cachedir is None:
+        return ProbeTable(parse_probes(xml))
+    digest = hashlib.sha1(xml).hexdigest()
+    fname = os.path.join(
+        cachedir, 'probes-{:d}-{:}.json'.format(TABLE_VERSION, digest)
+    )
+    try:
+        with open(fname, 'r') as fh:
+            return ProbeTable(json.load(fh))
+    except (IOError, OSError, ValueError):   # missing or partial file
+        pass
+    by_id = parse_probes(xml)
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp-', dir=cachedir)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(by_id, fh)
+        os.rename(tmpname, fname)
+    except (IOError, OSError):   # the cache is optional
+        pass
+    return ProbeTable(by_id)
+
+def probe_table():
+    '''Return the ProbeTable of the probes.xml file distributed with this
+    package. The file is read and parsed on the first call only.'''
+    global _probe_table
+    with _probe_table_lock:
+        if _probe_table is None:
+            import pkg_resources   # slow to import
+            _probe_table = _load_table(
+                pkg_resources.resource_string('ultratils.pysonix', 'data/probes.xml')
+            )
+        return _probe_table
 
 # TODO: make this inherit from a base Probe class that has pitch and radius attributes.
 class Probe:
-    '''A class for storing probe parameters.'''
+    '''A class for storing probe parameters. The fields attribute holds all
+    fields of the probe from the probe table.'''
     def __init__(self, probe_id):
+        self.id = probe_id
+        self.fields = {}
         if probe_id != None:
             self.probe_for_id(probe_id)
 
     def probe_for_id(self, id):
-        '''Populate a Probe by id. For now we only get the elements we know we need.'''
-        root = ET.fromstring(
-            pkg_resources.resource_string('ultratils.pysonix', 'data/probes.xml')
-        )
-        self.name = root.find('.//probe[@id="{}"]'.format(id)).get('name')
-        self.pitch = int(root.find('.//probe[@id="{}"]/pitch'.format(id)).text)
-        self.radius = int(root.find('.//probe[@id="{}"]/radius'.format(id)).text)
-        self.numElements = int(root.find('.//probe[@id="{}"]/numElements'.format(id)).text)
+        '''Populate a Probe by id.'''
+        self._populate(probe_table().fields_for_id(id))
+        self.id = id
+
+    def probe_for_name(self, name):
+        '''Populate a Probe by name.'''
+        fields = probe_table().fields_for_name(name)
+        self._populate(fields)
+        self.id = fields['id']
 
+    def _populate(self, fields):
+        self.fields = fields
+        self.name = fields['name']
+        self.pitch = int(fields['pitch'])
+        self.radius = int(fields['radius'])
+        self.numElements = int(fields['numElements'])
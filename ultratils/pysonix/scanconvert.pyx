@@ -1,8 +1,12 @@
 # Class for converting from .bpr (pre-scan converted b-mode data)
 
-import sys
+import os, sys
+import threading
 import numpy as np
 cimport numpy as np
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport floor
 NPINT = np.int
 ctypedef np.int_t NPINT_t
 NPFLOAT = np.float
@@ -10,30 +14,94 @@ ctypedef np.float_t NPFLOAT_t
 NPLONG = np.long
 ctypedef np.long_t NPLONG_t
 
-cdef cart2pol(NPFLOAT_t x, NPFLOAT_t y):
-    """Convert from cartesian to radian polar coordinates."""
-    cdef NPFLOAT_t radius = np.hypot(x,y)
-    cdef NPFLOAT_t theta = np.arctan2(y,x)
-    return theta, radius
-
-cdef pol2cart(NPFLOAT_t radius, NPFLOAT_t theta):
-    """Convert from polar to cartesian coordinates."""
-    x = radius * np.cos(theta)
-    y = radius * np.sin(theta)
-    return x, y
-
-cpdef scanconvert(np.ndarray[NPLONG_t, ndim=2] Iin, indt=None, indr=None):
-    '''Convert data from a .bpr to image data.'''
-    framedim = indt.shape
-    cdef np.ndarray[NPLONG_t, ndim=2] Iout = np.zeros(framedim, dtype=NPLONG)
-    cdef int xCntr, yCntr, indt_, indr_
-    for xCntr in np.arange(0, framedim[1]):
-        for yCntr in np.arange(0, framedim[0]):
-            indt_ = indt[yCntr, xCntr]
-            indr_ = indr[yCntr, xCntr]
-            if indt_>0 and indt_<Iin.shape[1] and indr_>0 and indr_<Iin.shape[0]:
-                Iout[yCntr, xCntr] = Iin[indr_, indt_]
-    return Iout
+from ultratils.pysonix.tablecache import TableCache, default_cache, table_key
+
+# Version of the Converter index tables. Change this when the calculation
+# of the tables changes to invalidate cached tables.
+TABLE_VERSION = 1
+
+# Converter attributes that are calculated on demand by _build_grid().
+_GRID_ATTRS = ('t', 'r', 'x', 'y', 'xreg', 'yreg', 'theta', 'rho', 'indt', 'indr')
+
+ctypedef fused pixel_t:
+    np.uint8_t
+    np.uint16_t
+    np.int16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+# Frame dtypes that the scanconvert kernels accept.
+KERNEL_DTYPES = (
+    np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.int16),
+    np.dtype(np.int32), np.dtype(np.int64), np.dtype(np.float32),
+    np.dtype(np.float64)
+)
+
+# Minimum number of frames in a batch for Converter to use the kernels.
+KERNEL_MIN_FRAMES = 8
+
+def _nthreads(nthreads):
+    """Return the number of worker threads to use for nthreads."""
+    if nthreads is None or nthreads <= 0:
+        return os.cpu_count() or 1
+    return nthreads
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def scanconvert(const pixel_t[:, ::1] Iin, pixel_t[:, ::1] Iout,
+const np.intp_t[::1] bpr_index, const np.intp_t[::1] bmp_index,
+const np.intp_t[::1] bg_index, pixel_t bgcolor=0, nthreads=None):
+    """Scan-convert a batch of frames by nearest-neighbor lookup.
+
+Iin = (n, h*w) array of flattened bpr or raw frames
+Iout = (n, H*W) array of flattened output frames to fill
+bpr_index, bmp_index = index tables of a Converter
+bg_index = indexes of the output pixels outside the fan
+bgcolor = background color value
+nthreads = number of worker threads; None or 0 for one per CPU
+
+The frames are divided among nthreads threads, which run without the GIL.
+"""
+    cdef Py_ssize_t fr, px
+    cdef Py_ssize_t nfan = bmp_index.shape[0]
+    cdef Py_ssize_t nbg = bg_index.shape[0]
+    cdef int nthr = _nthreads(nthreads)
+    for fr in prange(Iin.shape[0], nogil=True, num_threads=nthr, schedule='static'):
+        for px in range(nfan):
+            Iout[fr, bmp_index[px]] = Iin[fr, bpr_index[px]]
+        for px in range(nbg):
+            Iout[fr, bg_index[px]] = bgcolor
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def scanconvert_bilinear(const pixel_t[:, ::1] Iin, pixel_t[:, ::1] Iout,
+const np.intp_t[:, ::1] bil_index, const np.float32_t[:, ::1] bil_weight,
+const np.intp_t[::1] bmp_index, const np.intp_t[::1] bg_index,
+pixel_t bgcolor=0, nthreads=None):
+    """Scan-convert a batch of frames by bilinear interpolation.
+
+bil_index, bil_weight = bilinear interpolation tables of a Converter
+The other parameters are as for scanconvert(). Interpolated values of
+integer frames are rounded to the nearest integer.
+"""
+    cdef Py_ssize_t fr, px, k
+    cdef Py_ssize_t nfan = bmp_index.shape[0]
+    cdef Py_ssize_t nbg = bg_index.shape[0]
+    cdef double val
+    cdef int nthr = _nthreads(nthreads)
+    for fr in prange(Iin.shape[0], nogil=True, num_threads=nthr, schedule='static'):
+        for px in range(nfan):
+            val = 0.0
+            for k in range(4):
+                val = val + Iin[fr, bil_index[px, k]] * bil_weight[px, k]
+            if pixel_t is np.float32_t or pixel_t is np.float64_t:
+                Iout[fr, bmp_index[px]] = <pixel_t>val
+            else:
+                Iout[fr, bmp_index[px]] = <pixel_t>floor(val + 0.5)
+        for px in range(nbg):
+            Iout[fr, bg_index[px]] = bgcolor
 
 class Converter(object):
     """Converter for bpr to bmp frame data.
@@ -48,9 +116,25 @@ bmpdata = converter.convert(framedata)
 
 """
 
-    def __init__(self, header, probe, ppmm=2, *args, **kwargs):
+    def __init__(self, header, probe, ppmm=2, cache=None,
+interpolation='nearest', nthreads=None, dtype=np.uint8, roi=None, *args,
+**kwargs):
         """header = bpr header
 probe = Probe object
+ppmm = output pixels per mm; use a smaller value for lower resolution output,
+  e.g. for previews
+roi = optional (xmin, xmax, ymin, ymax) region of interest in mm, in the
+  same cartesian coordinates as fan_extent; if provided, the output frames
+  cover only this region
+interpolation = 'nearest' (default) to take the value of the nearest bpr
+  pixel, or 'bilinear' to interpolate between the four surrounding bpr
+  pixels
+dtype = data type of the frames to be converted; bpr data is uint8
+nthreads = number of threads used to convert batches of frames; None for
+  one per CPU
+cache = TableCache or cache directory name to load and store the index
+  tables; if None, the cache named by the ULTRATILS_CACHE_DIR environment
+  variable is used, if set; if False, no cache is used
 """
         super(Converter, self).__init__(*args, **kwargs)
         # TODO EchoB option for input of header/probe values
@@ -58,6 +142,13 @@ probe = Probe object
         self.input_h = header.h
         self.input_w = header.w
         self.probe = probe
+        if interpolation not in ('nearest', 'bilinear'):
+            msg = "Unknown interpolation '{:}'.".format(interpolation)
+            raise ValueError(msg)
+        self.interpolation = interpolation
+        self.nthreads = nthreads
+        self.roi = None if roi is None else tuple(float(v) for v in roi)
+        self.dtype = np.dtype(dtype)
 
         # apitch, lpitch, radius calculations and ppmm value drawn from
         # ultrasonix matlab code in SonixDataTools.m.
@@ -79,83 +170,307 @@ probe = Probe object
         # pixels per mm; hardcoded value of 2 in SonixDataTools.m
         self.ppmm = ppmm
 
+        # The index tables that map bpr pixels to bmp pixels depend only on
+        # the geometry, so they can be loaded from a TableCache if one is
+        # available instead of being calculated.
+        if cache is None:
+            cache = default_cache()
+        elif isinstance(cache, str):
+            cache = TableCache(cache)
+        names = ('bmp_index', 'bpr_index', 'shape')
+        if interpolation == 'bilinear':
+            names += ('bil_index', 'bil_weight')
+        tables = None
+        if cache:
+            key = table_key(
+                'Converter', TABLE_VERSION, float(probe.pitch),
+                float(probe.radius), int(probe.numElements), int(header.w),
+                int(header.h), float(header.sf), float(ppmm), interpolation,
+                self.roi
+            )
+            tables = cache.load(key, names)
+        if tables is None:
+            tables = self._build_tables()
+            if cache:
+                cache.store(key, tables)
+        self.bmp_index = tables['bmp_index']
+        self.bpr_index = tables['bpr_index']
+        if interpolation == 'bilinear':
+            self.bil_index = tables['bil_index']
+            self.bil_weight = tables['bil_weight']
+        self.shape = tuple(int(n) for n in tables['shape'])
+        self.bmp = np.zeros(self.shape, dtype=self.dtype)
+
+    def __getattr__(self, name):
+        # The coordinate grids are not stored in the cache. Calculate them
+        # the first time they are needed if the tables came from the cache.
+        if name in _GRID_ATTRS:
+            self._build_grid()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _build_grid(self):
+        """Calculate the polar coordinates of the bpr data and the cartesian
+coordinate grid of the output."""
+        header = self.header
         # The remaining calculations are drawn from ultrasonix matlab code
         # in scanconvert.m.
-        cdef np.ndarray t = np.zeros(header.h, dtype=NPFLOAT)
         t = (np.arange(0,header.w)-header.w/2)*self.lpitch/self.radius
-        self.t = t
-        self.r = self.radius + np.arange(0,header.h)*self.apitch
-        (self.t,self.r) = np.meshgrid(self.t,self.r)
+        r = self.radius + np.arange(0,header.h)*self.apitch
+        (self.t,self.r) = np.meshgrid(t,r)
         self.x = self.r*np.cos(self.t)
         self.y = self.r*np.sin(self.t)
 
-        xreg = np.arange(np.min(self.x), np.max(self.x), step=1e-3/self.ppmm)
-        yreg = np.arange(np.min(self.y), np.max(self.y), step=1e-3/self.ppmm)
-        [yreg, xreg] = np.meshgrid(yreg, xreg)
-        theta = np.zeros(xreg.shape, dtype=NPFLOAT)
-        rho = np.zeros(xreg.shape, dtype=NPFLOAT)
-        indt = np.zeros(xreg.shape, dtype=NPFLOAT)
-        indr = np.zeros(xreg.shape, dtype=NPFLOAT)
-        # TODO: vectorize?
-        bmp_index = []
-        bpr_index = []
-        for xCntr in np.arange(0, xreg.shape[1]):
-            for yCntr in np.arange(0, yreg.shape[0]):
-                [theta[yCntr, xCntr], rho[yCntr, xCntr]] = cart2pol(
-                    xreg[yCntr, xCntr], yreg[yCntr, xCntr]
-                )
-                indt = np.int(
-                    np.floor(
-                        theta[yCntr, xCntr]/(self.lpitch/self.radius)+header.w/2
-                    ) + 1
-                )
-                indr = np.int(
-                    np.floor(
-                        (rho[yCntr, xCntr]-self.radius)/self.apitch
-                    ) + 1
-                )
-                if indt>0 and indt<header.w and indr>0 and indr<header.h:
-                    bmp_index.append(
-                        np.ravel_multi_index((yCntr, xCntr), xreg.shape)
-                    )
-                    bpr_index.append(
-                        np.ravel_multi_index((indr, indt), (header.h, header.w))
-                    )
-        self.theta = theta
-        self.rho = rho
-        self.indt = indt
-        self.indr = indr
-        self.xreg = xreg
-        self.yreg = yreg
-        self.bmp_index = bmp_index
-        self.bpr_index = bpr_index
-        self.bmp = np.zeros(self.xreg.shape, dtype=NPLONG)
-        self._fan = np.zeros(self.xreg.shape, dtype=NPLONG)
+        if self.roi is None:
+            (xmin, xmax, ymin, ymax) = (
+                np.min(self.x), np.max(self.x), np.min(self.y), np.max(self.y)
+            )
+        else:
+            (xmin, xmax, ymin, ymax) = [v*1e-3 for v in self.roi]
+        xreg = np.arange(xmin, xmax, step=1e-3/self.ppmm)
+        yreg = np.arange(ymin, ymax, step=1e-3/self.ppmm)
+        [self.yreg, self.xreg] = np.meshgrid(yreg, xreg)
+        # Find the polar coordinates of every output pixel at once and map
+        # them to the nearest bpr scanline and sample.
+        self.theta = np.arctan2(self.yreg, self.xreg)
+        self.rho = np.hypot(self.xreg, self.yreg)
+        self.indt = np.floor(
+            self.theta/(self.lpitch/self.radius)+header.w/2
+        ).astype(np.intp) + 1
+        self.indr = np.floor(
+            (self.rho-self.radius)/self.apitch
+        ).astype(np.intp) + 1
+
+    @property
+    def fan_extent(self):
+        """The (xmin, xmax, ymin, ymax) extent of the fan in mm. The x axis
+runs along the rows of the output frames, away from the probe, and the y
+axis runs along the columns."""
+        return (
+            np.min(self.x)*1e3, np.max(self.x)*1e3,
+            np.min(self.y)*1e3, np.max(self.y)*1e3
+        )
+
+    def _build_tables(self):
+        """Calculate and return a dict of the index tables."""
+        header = self.header
+        indt = self.indt
+        indr = self.indr
+        inside = (indt>0) & (indt<header.w) & (indr>0) & (indr<header.h)
+        bmp_index = np.flatnonzero(inside)
+        bpr_index = np.ravel_multi_index(
+            (indr[inside], indt[inside]), (header.h, header.w)
+        )
+        tables = {
+            'bmp_index': bmp_index,
+            'bpr_index': bpr_index,
+            'shape': np.array(self.xreg.shape)
+        }
+        if self.interpolation == 'bilinear':
+            # Fractional bpr coordinates of the fan pixels. The nearest
+            # neighbor pixel is (indr, indt), so the four surrounding pixels
+            # start at (indr-1, indt-1), all of which are inside the frame.
+            ft = self.theta[inside]/(self.lpitch/self.radius)+header.w/2
+            fr = (self.rho[inside]-self.radius)/self.apitch
+            t0 = indt[inside] - 1
+            r0 = indr[inside] - 1
+            at = ft - t0
+            ar = fr - r0
+            base = r0*header.w + t0
+            tables['bil_index'] = np.column_stack(
+                (base, base+1, base+header.w, base+header.w+1)
+            )
+            tables['bil_weight'] = np.column_stack(
+                ((1-ar)*(1-at), (1-ar)*at, ar*(1-at), ar*at)
+            ).astype(np.float32)
+        return tables
 
     def bmp_overlay(self, theta, radius):
         """
         Return points specified in polar (bpr) coordinates as cartesian
-        points that can be plotted over a scanconverted bmp.
+        points that can be plotted over a scanconverted bmp. The points are
+        returned as a (row, col) tuple of arrays of bmp pixel coordinates;
+        see bpr_to_bmp().
 
         theta = bpr scanline index
         radius = bpr scanline height index
         """
-        points = np.zeros(self._fan.shape, dtype=NPLONG) * np.nan
-        points.ravel()[theta]
-        return points
+        return self.bpr_to_bmp(theta, radius)
+
+    @property
+    def _bpr_offset(self):
+        # In nearest-neighbor mode an output pixel takes the value of bpr
+        # pixel floor(f)+1 for fractional bpr coordinate f, so bpr pixel k
+        # covers f in [k-1, k) and is centered at f = k-0.5.
+        return 0.5 if self.interpolation == 'nearest' else 0.0
+
+    def _in_fan(self, ft, fr):
+        """Return a boolean mask of the fractional bpr coordinates (ft, fr)
+        that fall inside the fan."""
+        return (ft >= 0) & (ft < self.header.w-1) & (fr >= 0) & (fr < self.header.h-1)
+
+    def bpr_to_bmp(self, scanline, sample):
+        """
+        Transform points from bpr (scanline, sample) coordinates to bmp
+        pixel coordinates of the converted frames.
+
+        scanline = array of bpr scanline (column) indexes
+        sample = array of bpr sample (row) indexes, 0 nearest the probe
+
+        The indexes may be fractional. Return a (row, col) tuple of float
+        arrays of the same shape as the inputs. Points outside the fan are
+        NaN.
+        """
+        ft = np.asarray(scanline, dtype=float) - self._bpr_offset
+        fr = np.asarray(sample, dtype=float) - self._bpr_offset
+        theta = (ft-self.header.w/2)*self.lpitch/self.radius
+        rho = self.radius + fr*self.apitch
+        step = 1e-3/self.ppmm
+        row = (rho*np.cos(theta) - self.xreg[0, 0])/step
+        col = (rho*np.sin(theta) - self.yreg[0, 0])/step
+        inside = self._in_fan(ft, fr)
+        return (np.where(inside, row, np.nan), np.where(inside, col, np.nan))
+
+    def bmp_to_bpr(self, row, col):
+        """
+        Transform points from bmp pixel coordinates of the converted frames
+        to bpr (scanline, sample) coordinates.
+
+        row, col = arrays of bmp row and column coordinates
+
+        The coordinates may be fractional. Return a (scanline, sample)
+        tuple of float arrays of the same shape as the inputs. Rounding
+        them gives the bpr pixel that convert() uses for a bmp pixel.
+        Points outside the fan are NaN.
+        """
+        step = 1e-3/self.ppmm
+        x = self.xreg[0, 0] + np.asarray(row, dtype=float)*step
+        y = self.yreg[0, 0] + np.asarray(col, dtype=float)*step
+        ft = np.arctan2(y, x)/(self.lpitch/self.radius)+self.header.w/2
+        fr = (np.hypot(x, y)-self.radius)/self.apitch
+        inside = self._in_fan(ft, fr)
+        return (
+            np.where(inside, ft + self._bpr_offset, np.nan),
+            np.where(inside, fr + self._bpr_offset, np.nan)
+        )
 
     def convert(self, frame, bgcolor=0):
         """
         Return bpr or raw frame data as scan-converted ndarray.
 
-        frame = frame of unconverted bpr or raw data
+        frame = frame of unconverted bpr or raw data, or an (n, h, w) stack
+          of frames, which is converted with convert_many()
         bgcolor = background color value
+
+        A single frame is converted into a new array of the frame's dtype,
+        as convert_many() does, so that a Converter shared between threads
+        or acquisitions keeps no per-call state.
+        """
+        if frame.ndim == 3:
+            return self.convert_many(frame, bgcolor=bgcolor)
+        frame = np.asarray(frame)
+        out = np.empty((1,) + self.shape, dtype=frame.dtype)
+        return self.convert_many(frame[np.newaxis], out=out, bgcolor=bgcolor)[0]
+
+    def _sample(self, src):
+        """
+        Return the values of the fan pixels of the output for an (m, h*w)
+        array of frames, with the dtype of the frames.
+        """
+        if self.interpolation == 'nearest':
+            return src[:, self.bpr_index]
+        # Do the same arithmetic as scanconvert_bilinear(), so that a frame
+        # converts identically with or without the kernel: each product is
+        # taken in the precision C uses for pixel * float32 weight, the
+        # products are summed in order in double precision, and integer
+        # values are rounded half up.
+        if src.dtype == np.float64:
+            prod_dtype = np.float64
+        else:
+            prod_dtype = np.float32
+        vals = np.zeros((src.shape[0], self.bil_index.shape[0]), dtype=np.float64)
+        for k in range(4):
+            vals += src[:, self.bil_index[:, k]].astype(prod_dtype) * self.bil_weight[:, k]
+        if src.dtype.kind in 'iub':
+            vals += 0.5
+            np.floor(vals, out=vals)
+        return vals.astype(src.dtype, copy=False)
+
+    @property
+    def bg_index(self):
+        """The flat indexes of the output pixels outside the fan."""
+        try:
+            return self.__dict__['_bg_index']
+        except KeyError:
+            mask = np.ones(self.shape, dtype=bool)
+            mask.ravel()[self.bmp_index] = False
+            self._bg_index = np.flatnonzero(mask)
+            return self._bg_index
+
+    def convert_many(self, frames, out=None, bgcolor=0, chunk_frames=64):
         """
-        self._fan[:] = bgcolor 
-        if self._fan.dtype != frame.dtype:
-            self._fan = self._fan.astype(frame.dtype)
-        self._fan.ravel()[self.bmp_index] = frame.ravel()[self.bpr_index]
-        return self._fan
+        Return a stack of bpr or raw frames as an (n, H, W) ndarray of
+        scan-converted frames, where (H, W) is the converter's output shape.
+
+        frames = (n, h, w) ndarray of unconverted frames, or an iterable of
+          such arrays, e.g. chunks of frames read from a file
+        out = optional C-contiguous (n, H, W) array to fill, e.g. a memmap;
+          if None a new array of the frames' dtype is returned
+        bgcolor = background color value
+        chunk_frames = number of frames converted in each gather operation
+        """
+        if isinstance(frames, np.ndarray):
+            chunks = [frames]
+        else:
+            chunks = frames
+        if out is None:
+            chunks = [np.asarray(c) for c in chunks]
+            n = sum(len(c) for c in chunks)
+            dtype = chunks[0].dtype if n > 0 else self.dtype
+            out = np.empty((n,) + self.shape, dtype=dtype)
+        elif tuple(out.shape[1:]) != self.shape or not out.flags.c_contiguous:
+            msg = "Output must be a C-contiguous array of shape (n, {:d}, {:d})."
+            raise ValueError(msg.format(*self.shape))
+        bg_index = self.bg_index
+        pos = 0
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            if len(chunk) >= KERNEL_MIN_FRAMES and chunk.dtype == out.dtype \
+               and chunk.dtype in KERNEL_DTYPES:
+                # Convert big batches on multiple cores.
+                m = len(chunk)
+                src = np.ascontiguousarray(chunk).reshape(m, -1)
+                dst = out[pos:pos + m].reshape(m, -1)
+                self._kernel(src, dst, bgcolor)
+                pos += m
+                continue
+            for start in range(0, len(chunk), chunk_frames):
+                src = chunk[start:start + chunk_frames]
+                m = len(src)
+                src = src.reshape(m, -1)
+                dst = out[pos:pos + m].reshape(m, -1)
+                dst[:, self.bmp_index] = self._sample(src)
+                dst[:, bg_index] = bgcolor
+                pos += m
+        if pos != len(out):
+            msg = "Got {:d} frames for an output array of {:d} frames."
+            raise ValueError(msg.format(pos, len(out)))
+        return out
+
+    def _kernel(self, src, dst, bgcolor):
+        """Convert the (m, h*w) frames in src into the (m, H*W) array dst
+        with the scanconvert kernels."""
+        bgcolor = src.dtype.type(bgcolor)
+        if self.interpolation == 'nearest':
+            scanconvert(
+                src, dst, self.bpr_index, self.bmp_index, self.bg_index,
+                bgcolor, self.nthreads
+            )
+        else:
+            scanconvert_bilinear(
+                src, dst, self.bil_index, self.bil_weight, self.bmp_index,
+                self.bg_index, bgcolor, self.nthreads
+            )
 
     def as_bmp(self, frame):
         """
@@ -164,12 +479,58 @@ probe = Probe object
         """
         sys.stderr.write("WARNING: as_bmp is deprecated; use convert instead.")
         self.bmp[:] = 0
-        self.bmp.ravel()[self.bmp_index] = frame.ravel()[self.bpr_index]
+        self.bmp.ravel()[self.bmp_index] = self._sample(frame.reshape(1, -1))[0]
         return self.bmp.astype(frame.dtype, copy=False)
 
     def default_bpr_frame(self, default=0):
         """
         Return a frame of bpr data the same shape as defined by the header,
-        filled with a default value.
+        filled with a default value, in the converter's dtype.
         """
-        return  np.zeros([self.header.h, self.header.w]) + default
+        return np.full([self.header.h, self.header.w], default, dtype=self.dtype)
+
+# Process-wide registry of Converters keyed on their geometry, so that all
+# acquisitions with the same probe and bpr geometry share one Converter.
+_converters = {}
+_converters_lock = threading.Lock()
+
+def converter_key(header, probe, ppmm=2, interpolation='nearest',
+nthreads=None, dtype=np.uint8, roi=None):
+    """Return the registry key of the Converter for the given arguments."""
+    return (
+        str(getattr(probe, 'id', None)), float(probe.pitch), float(probe.radius),
+        int(probe.numElements), int(header.w), int(header.h),
+        float(header.sf), float(ppmm), interpolation, nthreads,
+        np.dtype(dtype).str, None if roi is None else tuple(float(v) for v in roi)
+    )
+
+def get_converter(header, probe, ppmm=2, interpolation='nearest',
+nthreads=None, dtype=np.uint8, roi=None, cache=None):
+    """Return the shared Converter for a geometry, creating it on first use.
+
+Converters are registered by probe id, bpr width, height and sampling
+frequency, ppmm and the other Converter parameters, and later calls with
+the same values return the same object. See Converter for the parameters;
+cache is only used when a new Converter is created.
+
+The convert() and convert_many() methods of a Converter return new arrays
+and keep no per-call state, so a shared Converter may be used from several
+threads at once. The deprecated as_bmp() method still returns a reused
+buffer.
+"""
+    key = converter_key(header, probe, ppmm, interpolation, nthreads, dtype, roi)
+    with _converters_lock:
+        converter = _converters.get(key)
+        if converter is None:
+            converter = Converter(
+                header, probe, ppmm=ppmm, cache=cache,
+                interpolation=interpolation, nthreads=nthreads, dtype=dtype,
+                roi=roi
+            )
+            _converters[key] = converter
+    return converter
+
+def clear_converters():
+    """Remove all Converters from the registry used by get_converter()."""
+    with _converters_lock:
+        _converters.clear()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Persistent on-disk cache of precomputed lookup tables, e.g. the index
+# tables of scan converters.
+
+# Each cache entry is a directory named by a key that is a hash of the
+# values that determine the tables' content. The directory contains one .npy
+# file per table, and tables are loaded as read-only memory maps. Entries
+# are written to a temporary directory that is renamed into place, so
+# concurrent writers of the same entry never expose a partial entry to
+# readers; the first rename wins and later writers discard their copy.
+# When the total size of the cache exceeds max_bytes the least recently
+# used entries are removed.
+
+import os
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+
+def default_cache_dir():
+    '''Return the cache directory named by the ULTRATILS_CACHE_DIR
+    environment variable, or None if it is not set.'''
+    return os.environ.get('ULTRATILS_CACHE_DIR')
+
+def default_cache():
+    '''Return a TableCache for the default cache directory, or None if no
+    default cache directory is set.'''
+    cachedir = default_cache_dir()
+    if cachedir is None:
+        return None
+    return TableCache(cachedir)
+
+def table_key(*values):
+    '''Return a cache key for the given values, which should be ints, floats
+    or strings that together determine the content of the tables.'''
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+class TableCache(object):
+    '''A directory of cached ndarray tables.
+
+    Parameters
+    ----------
+    cachedir : str
+    The cache directory. It is created if it does not exist. It does not
+    need to be writable; if it is not, tables are loaded but not stored. If
+    it cannot be created, load() finds no tables and store() does nothing.
+
+    Optional parameters
+    -------------------
+
+    max_bytes : int (default 512 MB)
+    The maximum total size of the cache entries.
+    '''
+    def __init__(self, cachedir, max_bytes=512*1024*1024):
+        self.cachedir = os.path.abspath(cachedir)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:   # the cache is optional; it stays empty
+                pass
+
+    def load(self, key, names):
+        '''Return a dict of the tables in names stored for key, loaded as
+        read-only memory maps, or None if there is no complete entry for
+        key.'''
+        entry = os.path.join(self.cachedir, key)
+        try:
+            tables = {}
+            for name in names:
+                tables[name] = np.load(
+                    os.path.join(entry, name + '.npy'), mmap_mode='r'
+                )
+        except (IOError, OSError, ValueError):   # missing or evicted entry
+            return None
+        try:
+            os.utime(entry, None)   # mark as recently used
+        except (IOError, OSError):   # read-only cache
+            pass
+        return tables
+
+    def store(self, key, tables):
+        '''Store a dict of ndarray tables for key. Nothing is stored if the
+        cache directory cannot be written, e.g. because it is read-only or
+        the disk is full.'''
+        try:
+            tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cachedir)
+        except (IOError, OSError):   # the cache is optional
+            return
+        try:
+            for name, table in tables.items():
+                np.save(os.path.join(tmpdir, name + '.npy'), table)
+            os.rename(tmpdir, os.path.join(self.cachedir, key))
+        except (IOError, OSError):   # another writer stored the entry first,
+                                     # or the entry could not be written
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        try:
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        '''Remove least recently used entries until the cache size does not
+        exceed max_bytes.'''
+        entries = []
+        total = 0
+        for key in os.listdir(self.cachedir):
+            if key.startswith('.tmp-'):
+                continue
+            entry = os.path.join(self.cachedir, key)
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(entry, f))
+                    for f in os.listdir(entry)
+                )
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:   # removed by another process
+                continue
+            total += size
+        entries.sort()
+        while total > self.max_bytes and len(entries) > 0:
+            (mtime, size, entry) = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -3,6 +3,10 @@
 import os, sys
 import numpy as np
 import hashlib
+import threading
+from ultratils.frameio import as_indices, read_frames, frames_out, pread, \
+    follow, Prefetcher
+from ultratils.fingerprint import fingerprints
 
 class RawReader(object):
     '''Class for reading uniform binary ultrasound data from a file.
@@ -48,11 +52,22 @@ class RawReader(object):
     The number of header bytes to skip before the data section of the file.
     Default value indicates no header.
 
+    Thread safety
+    -------------
+
+    Frames are read with positional reads that neither use nor move a
+    shared file position, so `get_frame()`, `get_frames()` and iteration
+    may be called concurrently from multiple threads on a single reader.
+    When several threads iterate over the same reader each frame is
+    returned to exactly one of them. Do not call `close()` while other
+    threads are reading.
+
     '''
     def __init__(self, filename, nscanlines, npoints, dtype=np.uint8,
 data_offset=0, checksum=False):
         self.filename = os.path.abspath(filename)
         self._fhandle = None
+        self._lock = threading.RLock()
         self.nscanlines = nscanlines
         self.npoints = npoints
         self.points_per_frame = npoints * nscanlines
@@ -72,22 +87,25 @@ data_offset=0, checksum=False):
             sys.stderr.write(' File size {:} bytes.'.format(st.st_size))
             sys.stderr.write(' Frame size {:} bytes.'.format(self.framesize))
         self.nframes = np.int((st.st_size - self.data_offset) / self.framesize)
-        self._cursor = 0
+        self._cursor = self.data_offset
         self.open()
 
     @property
     def data(self):
-        '''Return all data as 3-dimensional ndarray.'''
+        '''Return all data as 3-dimensional ndarray of shape
+        (nframes, npoints, nscanlines). The array is a read-only, rotated
+        view of a memory map of the file, so frame data is only read from
+        disk as it is accessed.'''
         if self._data is None:
-            self._cursor = self._fhandle.tell()
-            self._fhandle.seek(self.data_offset)
-            data = np.fromfile(self._fhandle, self.dtype)
-            self._fhandle.seek(self._cursor)
-            imdims = [self.nframes, self.nscanlines, self.npoints]
-            try:
-                self._data = np.rot90(data.reshape(imdims), axes=(1, 2))
-            except TypeError: # numpy < v1.12
-                self._data = np.array([np.rot90(fr) for fr in data.reshape(imdims)])
+            imdims = (self.nframes, self.nscanlines, self.npoints)
+            if self.nframes > 0:
+                data = np.memmap(
+                    self.filename, dtype=self.dtype, mode='r',
+                    offset=self.data_offset, shape=imdims
+                )
+            else:   # mmap cannot map an empty region
+                data = np.zeros(imdims, dtype=self.dtype)
+            self._data = data[:, :, ::-1].transpose(0, 2, 1)  # rot90 of each frame
         return self._data
 
     @property
@@ -96,13 +114,25 @@ data_offset=0, checksum=False):
         Return a list of SHA1 checksums for each image frame.
         '''
         csums = [None] * self.nframes
+        seen = set()
         for idx,frame in enumerate(self):
             csum = hashlib.sha1(frame.copy(order="c")).hexdigest()
-            if csum in csums:
+            if csum in seen:
                 sys.stderr.write("Frame {:d} is a duplicate!".format(idx))
+            seen.add(csum)
             csums[idx] = csum
         return csums
 
+    @property
+    def fingerprints(self):
+        '''
+        Return a 1D uint64 ndarray of fast fingerprint checksums, one for
+        each image frame. See ultratils.fingerprint for functions that use
+        these to find duplicate and frozen frames.
+        '''
+        # Undo the rotation to fingerprint the file layout without a copy.
+        return fingerprints(np.rot90(self.data, -1, axes=(1, 2)))
+
     # Define __enter__ and __exit__ to create context manager.
     def __enter__(self):
         return self
@@ -116,16 +146,20 @@ data_offset=0, checksum=False):
     def __next__(self):
         '''
         Get next frame, used to iterate through the images one at a time.
-        You should not make other reads on the file handle while iterating
-        through the reader.
+        When the end of the file is reached the reader rewinds to the first
+        frame.
         '''
+        with self._lock:
+            cursor = self._cursor
+            self._cursor += self.framesize
+        data = pread(self._fhandle, self.framesize, cursor, self._lock)
         try:
-            data = self._fhandle.read(self.framesize)
-            assert(len(data) == self.points_per_frame)
-            data = np.fromstring(data, dtype=self.dtype)
+            assert(len(data) == self.framesize)
+            data = np.frombuffer(data, dtype=self.dtype)
         except AssertionError as e:
             if len(data) == 0:
-                self._fhandle.seek(self.data_offset)
+                with self._lock:
+                    self._cursor = self.data_offset
                 raise StopIteration  # ran out of data at end of file
             else:
                 raise RuntimeError('Got unexpected number of data points.')
@@ -136,16 +170,75 @@ data_offset=0, checksum=False):
         Get the image frame specified by idx. Do not advance the read
         location of _fhandle.
         '''
-        self._fhandle.seek(self.data_offset + (idx * self.framesize))
-        data = self._fhandle.read(self.framesize)
+        offset = self.data_offset + (idx * self.framesize)
+        data = pread(self._fhandle, self.framesize, offset, self._lock)
         try:
-            assert(len(data) == self.points_per_frame)
+            assert(len(data) == self.framesize)
         except AssertionError:
             raise IndexError('{:}'.format(idx))
-        self._fhandle.seek(self._cursor)
-        data = np.fromstring(data, self.dtype)
+        data = np.frombuffer(data, self.dtype)
         return np.rot90(data.reshape([self.nscanlines, self.npoints]))
 
+    def get_frames(self, idx, out=None):
+        '''
+        Get the image frames specified by idx and return them as a
+        contiguous (n, npoints, nscanlines) ndarray. idx may be a slice,
+        a range, or a sequence or ndarray of frame indexes in any order.
+        Neighboring frames are read from the file together. If out is
+        provided it must be an array of the same shape and is filled and
+        returned. Do not advance the read location of _fhandle.
+        '''
+        indices = as_indices(idx, self.nframes)
+        shape = [len(indices), self.npoints, self.nscanlines]
+        out = frames_out(out, shape, self.dtype)
+        frames = read_frames(
+            self._fhandle, indices, self.data_offset, self.framesize,
+            self.dtype, self._lock
+        )
+        frames = frames.reshape([len(indices), self.nscanlines, self.npoints])
+        out[...] = frames[:, :, ::-1].transpose(0, 2, 1)  # rot90 of each frame
+        return out
+
+    def prefetch(self, idx=None, depth=8):
+        '''
+        Return an iterator over the frames in idx (all frames if None)
+        that reads up to depth frames ahead in a background thread. Each
+        frame it returns is a buffer that is only valid until the next
+        frame is requested. The iterator has `stalls`, `producer_stalls`,
+        `depth` and `max_depth` counters; see ultratils.frameio.Prefetcher.
+        '''
+        if idx is None:
+            idx = slice(None)
+        indices = as_indices(idx, self.nframes)
+        return Prefetcher(self, indices, [self.npoints, self.nscanlines], self.dtype, depth)
+
+    def refresh(self):
+        '''
+        Update nframes with the number of complete frames currently in the
+        file, e.g. while the file is still being written. Return the new
+        value of nframes.
+        '''
+        st = os.stat(self.filename)
+        nframes = max(st.st_size - self.data_offset, 0) // self.framesize
+        with self._lock:
+            if nframes != self.nframes:
+                self._data = None
+            self.nframes = nframes
+        return nframes
+
+    def follow(self, start=0, poll_interval=0.1, timeout=None, until=None):
+        '''
+        Yield frames as they are appended to a file that is still being
+        written, beginning with frame index start.
+
+        poll_interval = seconds to wait between checks for new frames
+        timeout = stop when no new frames have arrived for this many seconds;
+          if None, wait indefinitely
+        until = optional callable; stop when it returns True and all frames
+          on disk have been yielded (e.g. when the acquisition process exits)
+        '''
+        return follow(self, start, poll_interval, timeout, until)
+
     def open(self):
         self._fhandle = open(self.filename, 'rb')
 
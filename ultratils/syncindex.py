@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Vectorized lookup of image frames by time.
+
+# A SyncIndex holds the synchronization intervals of an acquisition as NumPy
+# arrays: the start and end time of each interval and the pulse_idx and
+# raw_data_idx values of the interval. Intervals without a data frame, e.g.
+# those labelled 'NA' in the raw_data_idx tier of a .sync.TextGrid, have a
+# raw_data_idx of -1 and are marked in the missing mask. Times are resolved
+# to intervals with np.searchsorted, so that many times can be looked up at
+# once.
+
+# A SyncIndex can be saved to and loaded from a small .npz file, which
+# psync.sync2text() writes next to the .sync.TextGrid as a sidecar so that
+# readers do not have to parse the TextGrid.
+
+from collections import namedtuple
+import numpy as np
+
+# The times and raw_data_idx text of one interval, with the attributes of an
+# audiolabel Label.
+SyncLabel = namedtuple('SyncLabel', 't1, t2, text')
+
+def _label_ints(labels):
+    '''Return the texts of labels as an int ndarray, with -1 for labels that
+    are not integers, e.g. 'NA' or ''.'''
+    vals = np.full(len(labels), -1, dtype=np.int64)
+    for i, l in enumerate(labels):
+        try:
+            vals[i] = int(l.text)
+        except ValueError:
+            pass
+    return vals
+
+class SyncIndex(object):
+    '''Index of the synchronization intervals of an acquisition.
+
+    Parameters
+    ----------
+    t1, t2 : array-like of float
+    The start and end times of the intervals, in increasing order.
+
+    raw_data_idx : array-like of int
+    The index of the image data frame of each interval, or -1 if the
+    interval has no frame.
+
+    Optional parameters
+    -------------------
+
+    pulse_idx : array-like of int (default None)
+    The synchronization pulse index of each interval, or -1 if the interval
+    does not start at a pulse.
+    '''
+    def __init__(self, t1, t2, raw_data_idx, pulse_idx=None):
+        self.t1 = np.asarray(t1, dtype=np.float64)
+        self.t2 = np.asarray(t2, dtype=np.float64)
+        self.raw_data_idx = np.asarray(raw_data_idx, dtype=np.int64)
+        if pulse_idx is None:
+            pulse_idx = np.full(len(self.t1), -1, dtype=np.int64)
+        self.pulse_idx = np.asarray(pulse_idx, dtype=np.int64)
+        self.missing = self.raw_data_idx < 0
+        # Index of the nearest interval with a frame at or before (prev) and
+        # at or after (next) each interval, or -1 if there is none.
+        pos = np.arange(len(self.t1))
+        prev = np.where(self.missing, -1, pos)
+        self._prev = np.maximum.accumulate(prev) if len(prev) > 0 else prev
+        nxt = np.where(self.missing, len(pos), pos)
+        if len(nxt) > 0:
+            nxt = np.minimum.accumulate(nxt[::-1])[::-1]
+        self._next = np.where(nxt == len(pos), -1, nxt)
+
+    @classmethod
+    def from_label_manager(cls, lm):
+        '''Create a SyncIndex from the pulse_idx and raw_data_idx tiers of an
+        audiolabel LabelManager of a .sync.TextGrid.'''
+        pulses = list(lm.tier('pulse_idx'))
+        try:
+            frames = list(lm.tier('raw_data_idx'))
+            raw_data_idx = _label_ints(frames)
+        except (IndexError, KeyError, ValueError):   # synced without an index file
+            raw_data_idx = np.full(len(pulses), -1, dtype=np.int64)
+        return cls(
+            [l.t1 for l in pulses], [l.t2 for l in pulses], raw_data_idx,
+            _label_ints(pulses)
+        )
+
+    @classmethod
+    def load(cls, filename):
+        '''Load a SyncIndex from an .npz file written by save().'''
+        with np.load(filename) as npz:
+            return cls(npz['t1'], npz['t2'], npz['raw_data_idx'], npz['pulse_idx'])
+
+    def save(self, filename):
+        '''Save the SyncIndex to an .npz file.'''
+        with open(filename, 'wb') as fh:
+            np.savez(
+                fh, t1=self.t1, t2=self.t2, raw_data_idx=self.raw_data_idx,
+                pulse_idx=self.pulse_idx
+            )
+
+    def __len__(self):
+        return len(self.t1)
+
+    def interval_at(self, times):
+        '''Return an int ndarray with the index of the interval that contains
+        each of times, or -1 for times outside all intervals. An interval
+        contains the times t1 <= t < t2; the end time of the last interval
+        belongs to the last interval.'''
+        times = np.asarray(times, dtype=np.float64)
+        if len(self) == 0:
+            return np.full(times.shape, -1, dtype=np.intp)
+        iidx = np.searchsorted(self.t1, times, side='right') - 1
+        safe = np.maximum(iidx, 0)
+        last = (safe == len(self) - 1) & (times <= self.t2[-1])
+        inside = (iidx >= 0) & ((times < self.t2[safe]) | last)
+        return np.where(inside, iidx, -1)
+
+    def intervals_between(self, t1=None, t2=None):
+        '''Return an int ndarray with the indexes of the intervals that
+        overlap the time range from t1 to t2. A range end that is None is
+        open.'''
+        keep = np.ones(len(self), dtype=bool)
+        if t1 is not None:
+            keep &= self.t2 > t1
+        if t2 is not None:
+            keep &= self.t1 < t2
+        return np.flatnonzero(keep)
+
+    def label(self, iidx):
+        '''Return a SyncLabel for interval iidx, with a text of 'NA' if the
+        interval has no frame.'''
+        fidx = self.raw_data_idx[iidx]
+        return SyncLabel(
+            float(self.t1[iidx]), float(self.t2[iidx]),
+            'NA' if fidx < 0 else str(fidx)
+        )
+
+    def frame_intervals(self, times, missing=None):
+        '''Return an int ndarray with the index of the interval whose frame
+        is used for each of times, or -1 where there is none. See
+        frame_indexes() for missing.'''
+        if missing not in (None, 'prev', 'next'):
+            msg = "Unknown missing frame method '{:}'.".format(missing)
+            raise ValueError(msg)
+        iidx = self.interval_at(times)
+        if len(self) == 0:
+            return iidx
+        safe = np.maximum(iidx, 0)
+        if missing == 'prev':
+            return np.where(iidx >= 0, self._prev[safe], -1)
+        elif missing == 'next':
+            return np.where(iidx >= 0, self._next[safe], -1)
+        return np.where((iidx >= 0) & ~self.missing[safe], iidx, -1)
+
+    def frame_indexes(self, times, missing=None):
+        '''Return an int ndarray with the raw_data_idx of the frame at each of
+        times, or -1 where there is none.
+
+        missing = None to return -1 for times in intervals without a frame;
+          'prev' or 'next' to return the nearest frame before or after the
+          interval instead, if there is one
+        '''
+        iidx = self.frame_intervals(times, missing)
+        if len(self) == 0:
+            return iidx
+        return np.where(iidx >= 0, self.raw_data_idx[np.maximum(iidx, 0)], -1)
@@ -24,14 +24,16 @@ def standard_dev(bprfile, depth, factor):
 depth is the number of rows (closest to the transducer) in which to examine the standard deviation
 factor is multiplied by the mean standard deviation to find a threshold'''
 # Number of rows in which to check for changes. Row 0 is nearest the transducer.
-    rdr = BprReader(bprfile)
-    prev = rdr.get_frame(0)[range(depth),:]
-    stds = np.zeros([rdr.header.nframes])
-    for idx in range(1,rdr.header.nframes):
-        frame = rdr.get_frame(idx)[range(depth),:]
-        dframe = np.abs(frame - prev)
-        stds[idx] = np.std(dframe)
-        prev = frame
+    # Only the first depth rows of each frame are read, from the memory map
+    # of the file, in which frames are (w, h) and rows are its last axis.
+    rows = BprReader(bprfile, memmap=True).data[:, :, :depth]
+    stds = np.zeros([len(rows)])
+    chunk = 256
+    for start in range(1, len(rows), chunk):
+        frames = rows[start - 1:start + chunk].astype(int)
+        stds[start:start + chunk] = np.std(
+            np.abs(np.diff(frames, axis=0)), axis=(1, 2)
+        )
     
     threshold = factor * np.mean(stds)
     # Find the frame indexes where the threshold is exceeded.
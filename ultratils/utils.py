@@ -2,17 +2,15 @@
 
 import os, sys
 import errno
+from collections import OrderedDict
 from datetime import datetime
 from dateutil.tz import tzlocal
 import numpy as np
-import pandas as pd
-try:
-    import ultratils.acq
-except:
-    pass
-import audiolabel
 from ultratils.pysonix.bprreader import BprReader
 
+# ultratils.acq and pandas are slow to import and are imported by the
+# functions that use them.
+
 def make_acqdir(datadir):
     """Make a timestamped directory in datadir and return a tuple with its 
 name and timestamp. Does not complain if directory already exists."""
@@ -29,22 +27,101 @@ name and timestamp. Does not complain if directory already exists."""
             raise
     return (acqdir, tstamp)
 
-def extract_frames(expdir, list_filename=None, frames=None):
+def _extract_acq(expdir, index, tstamp, dtype, fr_ids, is_time, fields, data,
+positions, chunk_frames):
+    """Extract the frames fr_ids of one acquisition into data at positions,
+and return a list of (position, metadata dict) tuples. If the acquisition
+cannot be read its frames are left filled with zeros and its rows have a
+raw_data_idx of None."""
+    import ultratils.acq
+    a = None
+    try:
+        if index.path(tstamp) is None:
+            raise ultratils.acq.AcqError('No acquisition directory found.')
+        a = ultratils.acq.Acq(
+            timestamp=tstamp,
+            expdir=expdir,
+            dtype=dtype,
+            index=index
+        )
+        a.gather()
+        if dtype != 'bpr':
+            raise ultratils.acq.AcqError('Only bpr data is supported.')
+        rdr = a.image_reader
+        if (rdr.h, rdr.w) != tuple(data.shape[1:]):
+            msg = 'Image shape {:} does not match the output frame shape {:}.'
+            raise ultratils.acq.AcqError(
+                msg.format((rdr.h, rdr.w), tuple(data.shape[1:]))
+            )
+        if is_time:
+            fidx = a.sync_index.frame_indexes(fr_ids)
+        else:
+            fidx = np.asarray(fr_ids, dtype=np.int64)
+        found = (fidx >= 0) & (fidx < rdr.nframes)
+        # Read each distinct frame once, in chunks of neighboring frames.
+        (uniq, inverse) = np.unique(fidx[found], return_inverse=True)
+        dest = positions[found]
+        for start in range(0, len(uniq), chunk_frames):
+            stop = min(start + chunk_frames, len(uniq))
+            sel = (inverse >= start) & (inverse < stop)
+            frames = rdr.get_frames(uniq[start:stop])
+            data[dest[sel]] = frames[inverse[sel] - start]
+    except Exception as e:
+        sys.stderr.write(
+            "Could not extract frames from {:}: {:}\n".format(tstamp, e)
+        )
+        data[positions] = 0
+        fidx = np.zeros(len(positions), dtype=np.int64)
+        found = np.zeros(len(positions), dtype=bool)
+    meta = OrderedDict()
+    for fld in fields:
+        if a is None:
+            meta[fld] = tstamp if fld == 'timestamp' else None
+            continue
+        try:
+            meta[fld] = a.as_dict([fld])[fld]
+        except Exception:   # not available for an unreadable acquisition
+            meta[fld] = None
+    results = []
+    for pos, fr_idx, ok in zip(positions, fidx, found):
+        rowmeta = meta.copy()
+        rowmeta['raw_data_idx'] = int(fr_idx) if ok else None
+        results.append((pos, rowmeta))
+    return results
+
+def extract_frames(expdir, list_filename=None, frames=None, out=None,
+workers=1, chunk_frames=256):
     """Extract image frames from specified acquisitions and return as a numpy array and
 dataframe with associated metadata.
 
 list_filename = filename containing a list of tuple triples, as in frames
 frames = list of tuple triples containing an acquisition timestamp string, a
-    raw_data_idx frame index, and data type (default is 'bpr')
+    raw_data_idx frame index or a time in seconds, and data type (default is 'bpr')
 expdir = the root experiment data directory
+out = optional output for the frames: the name of a .npy file to create and
+    fill through a memory map, or an array or memmap of shape
+    (nframes, h, w) to fill; if None the frames are returned in memory
+workers = number of acquisitions to extract concurrently
+chunk_frames = maximum number of frames read from a file at once
+
+The requested frames are grouped by acquisition. Each acquisition's
+metadata, sync index and image reader are loaded once, and its frames are
+read in batches of neighboring frames and written directly to the output,
+so the frames do not need to fit in memory when out is a file.
 
 Returns an (np.array, pd.DataFrame) tuple in which the array contains the frames of
 image data and the DataFrame contains acquisition metadata. The rows of the
-DataFrame correspond to the first axis of the array.
+DataFrame correspond to the first axis of the array. The array has the dtype of
+the image data, and frames that could not be extracted are filled with zeros
+and have a raw_data_idx of None.
 """
+    import concurrent.futures
+    import pandas as pd
+    import ultratils.acq
+    import ultratils.exp
     fields = ['stimulus', 'timestamp', 'utcoffset', 'versions', 'n_pulse_idx',
                'n_raw_data_idx', 'pulse_max', 'pulse_min', 'imaging_params',
-               'n_frames', 'image_w', 'image_h', 'probe']
+               'n_frames', 'image_w', 'image_h', 'probe_id']
     
     if list_filename is not None:
         frames = pd.read_csv(list_filename, sep='\s+', header=None)
@@ -53,49 +130,60 @@ DataFrame correspond to the first axis of the array.
     if frames.shape[1] == 2:
         frames['dtype'] = 'bpr'
     frames.columns = ['tstamp', 'fr_id', 'dtype']
+    # Assume fr_id is a raw_data_idx if it's an integer; otherwise it's a time.
+    is_time = 'fr_id' not in frames.select_dtypes(include=['integer']).columns
+    groups = list(frames.groupby(['tstamp', 'dtype'], sort=False).indices.items())
+    index = ultratils.exp.ExpIndex(expdir)
 
-    rows = []
-    data = None
-    for idx, rec in frames.iterrows():
-        a = ultratils.acq.Acq(
-            timestamp=rec['tstamp'],
-            expdir=expdir,
-            dtype=rec['dtype']
-        )
-        a.gather()
-        if idx == 0:
-            for v in a.runtime_vars:
-                fields.insert(0, v.name)
-        if rec['dtype'] == 'bpr':
-            rdr = BprReader(a.abs_image_file)
-        else:
-            raise AcqError('Only bpr data is supported.')
-
-        # Initialize array with NaN on first pass.
-        if data is None:
-            data = np.zeros([len(frames), rdr.header.h, rdr.header.w]) * np.nan
-
-        # Assume fr_id is a raw_data_idx if it's an integer; otherwise it's a time.
+    # Get the runtime variable names and the frame shape and dtype from the
+    # first acquisition that has readable image data.
+    for (tstamp, dtype), grows in groups:
+        if index.path(tstamp) is None:
+            continue
         try:
-            if 'fr_id' in frames.select_dtypes(include=['integer']).columns:
-                fr_idx = rec['fr_id']
-            else:
-                lm = audiolabel.LabelManager(
-                    from_file=a.abs_sync_tg,
-                    from_type='praat'
-                )
-                fr_idx = int(lm.tier('raw_data_idx').label_at(rec['fr_id']).text)
-            data[idx] = rdr.get_frame(fr_idx)
-        except Exception as e: 
-            fr_idx = None
-        row = a.as_dict(fields)
-        row['raw_data_idx'] = fr_idx
-        rows.append(row)
-    return (data, pd.DataFrame.from_records(rows))
+            a = ultratils.acq.Acq(timestamp=tstamp, expdir=expdir, dtype=dtype, index=index)
+            rdr = a.image_reader
+            break
+        except (ultratils.acq.AcqError, IOError, OSError, ValueError):
+            continue
+    else:
+        raise IOError('No image data found for the requested acquisitions.')
+    for v in a.runtime_vars or []:
+        fields.insert(0, v.name)
+    shape = [len(frames), rdr.h, rdr.w]
+    if out is None:
+        data = np.zeros(shape, dtype=rdr.dtype)
+    elif isinstance(out, str):
+        data = np.lib.format.open_memmap(out, mode='w+', dtype=rdr.dtype, shape=tuple(shape))
+    else:
+        data = out
+        if tuple(data.shape) != tuple(shape):
+            msg = 'Output array has shape {:}; expected {:}.'
+            raise ValueError(msg.format(data.shape, tuple(shape)))
+        data[...] = 0
+
+    fr_ids = frames['fr_id'].values
+    rows = [None] * len(frames)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                _extract_acq, expdir, index, tstamp, dtype, fr_ids[grows],
+                is_time, fields, data, grows, chunk_frames
+            )
+            for (tstamp, dtype), grows in groups
+        ]
+        for f in futures:
+            for row, rowmeta in f.result():
+                rows[row] = rowmeta
+    if isinstance(data, np.memmap):
+        data.flush()
+    # The probe column holds the probe id.
+    df = pd.DataFrame.from_records(rows).rename(columns={'probe_id': 'probe'})
+    return (data, df)
 
 def is_white_bpr(bpr_file_name):
     """check for 'white fan of death' BPRs (unusually bright shading and loss of contrast information)."""
-    check_bpr = ultratils.pysonix.bprreader.BprReader(bpr_file_name) # select first frame for checking - problem does seem to manifest here.
+    check_bpr = BprReader(bpr_file_name) # select first frame for checking - problem does seem to manifest here.
     frame = check_bpr.get_frame(0)
     if (np.mean(frame) > 200) and (np.var(frame) < 1200):
         return True
@@ -104,9 +192,9 @@ def is_white_bpr(bpr_file_name):
 
 def is_frozen_bpr(bpr_file_name):
     """check for frozen BPRs (identical frame-to-frame)."""
-    check_bpr_first = ultratils.pysonix.bprreader.BprReader(bpr_file_name) # select first and second frames for checking - problem does seem to manifest here.
+    check_bpr_first = BprReader(bpr_file_name) # select first and second frames for checking - problem does seem to manifest here.
     frame_first = check_bpr_first.get_frame(0)
-    check_bpr_second = ultratils.pysonix.bprreader.BprReader(bpr_file_name)
+    check_bpr_second = BprReader(bpr_file_name)
     frame_second = check_bpr_first.get_frame(1)
     if np.array_equal(frame_first,frame_second):
         return True